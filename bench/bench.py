@@ -0,0 +1,459 @@
+#! /usr/bin/env python
+"""Microbenchmarks of the msgbox hot paths.
+
+Every benchmark times a single operation many times and reports the
+throughput, the latency percentiles and the gc-tracked objects left
+behind per operation (objs/op, negative when the operation frees
+more than it allocates). The throughput is measured on loops of ops,
+the latency on further ops timed one by one: a pair of timer() calls
+would outweigh the sub-microsecond ops. State files are written under
+a scratch HOME.
+
+    $ python bench/bench.py                      # run and report
+    $ python bench/bench.py --save base.json     # record a baseline
+    $ python bench/bench.py --compare base.json  # fail on regressions
+
+Benchmarks only use the public api of msgbox, so that this script can
+time an older tree too (put it first in PYTHONPATH). Those the older
+tree has no api for are reported as n/a.
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from timeit import default_timer as timer
+
+# msgbox resolves its state files at import time
+SCRATCH_HOME = tempfile.mkdtemp(prefix='msgbox-bench-')
+os.environ['HOME'] = SCRATCH_HOME
+# appended: a tree given in PYTHONPATH comes first
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+from gsmmodem.pdu import Concatenation
+
+from msgbox.actor import Actor, Message, Timeout
+
+
+BENCHMARKS = []
+
+
+def benchmark(n):
+    """Register a benchmark run `n` times (scaled by --scale).
+
+    The decorated function gets the total number of operations (warm-up
+    included), does the setup and returns (op, teardown): op(i) is the
+    timed operation, teardown() is called once at the end.
+    """
+    def decorator(fun):
+        BENCHMARKS.append((fun.__name__, n, fun))
+        return fun
+    return decorator
+
+
+class NotAvailable(Exception):
+    """The msgbox tree under test lacks the api of a benchmark."""
+
+
+class Ping(Message): pass
+class Pong(Message): pass
+
+
+class BenchActor(Actor):
+    """Never started: msgs are drained by the benchmark itself."""
+
+    def __init__(self, dev='/dev/bench', imsi=None):
+        super(BenchActor, self).__init__(dev)
+        self.dev = dev
+        self.imsi = imsi
+        self.state = 'working'
+
+    def drain(self):
+        while not isinstance(self.receive(block=False), Timeout):
+            pass
+
+
+def _noop(*args):
+    pass
+
+
+@benchmark(200000)
+def actor_send_receive(n):
+    actor = BenchActor()
+    msg = Ping()
+    def op(i):
+        actor.send(msg)
+        actor.receive(block=False)
+    return op, _noop
+
+
+@benchmark(200000)
+def actor_selective_receive_backlog(n):
+    # a receive of Pong must skip 10000 queued Ping
+    actor = BenchActor()
+    for i in xrange(10000):
+        actor.send(Ping())
+    msg = Pong()
+    def op(i):
+        actor.send(msg)
+        actor.receive(Pong, block=False)
+    return op, _noop
+
+
+def _segment(sender, reference, parts, number):
+    concat = Concatenation()
+    concat.reference = reference
+    concat.parts = parts
+    concat.number = number
+    return dict(sender=sender, recipient='+393480000000',
+                text='x' * 153, tstamp=None, url='http://localhost/',
+                concat=concat)
+
+
+_forwarder = []
+
+
+def _start_forwarder():
+    """Start the manager forwarding received sms, in async mode: nothing
+    is delivered while the IOLoop is not running."""
+    from msgbox.http import http_client_manager
+    if not _forwarder:
+        http_client_manager.configure(mode='async', concurrency=10)
+        http_client_manager.start()
+        _forwarder.append(http_client_manager)
+    return http_client_manager
+
+
+def _stop_forwarder():
+    for manager in _forwarder:
+        manager.stop()
+
+
+class _Sink(object):
+    """Local webhook counting the forwarded sms, served by the IOLoop."""
+
+    def __init__(self):
+        import tornado.httpserver
+        import tornado.netutil
+        import tornado.web
+        sink = self
+        class SinkHandler(tornado.web.RequestHandler):
+            def post(self):
+                sink.received += 1
+                if sink.received >= sink.target:
+                    sink.ioloop.stop()
+        from msgbox.http import ioloop
+        self.ioloop = ioloop
+        self.received = 0
+        self.target = 0
+        sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+        self.url = 'http://127.0.0.1:%d/' % sockets[0].getsockname()[1]
+        self.server = tornado.httpserver.HTTPServer(
+                    tornado.web.Application([(r'/', SinkHandler)]))
+        self.server.add_sockets(sockets)
+
+    def wait(self, target, timeout=60):
+        """Run the IOLoop until `target` sms have been received."""
+        self.target = target
+        if self.received >= target:
+            return
+        deadline = self.ioloop.add_timeout(time.time() + timeout,
+                                           self.ioloop.stop)
+        self.ioloop.start()
+        self.ioloop.remove_timeout(deadline)
+        if self.received < target:
+            raise RuntimeError('sink: %d sms received out of %d' %
+                               (self.received, target))
+
+    def close(self):
+        self.server.stop()
+
+
+@benchmark(5000)
+def http_client_delivery(n):
+    # forwarded in batches of 500: the IOLoop runs until all arrived
+    manager = _start_forwarder()
+    sink = _Sink()
+    rx_sms = dict(sender='+393331234567', recipient='+393480000000',
+                  text='x' * 153, tstamp='2014-01-01 00:00:00',
+                  url=sink.url)
+    def op(i):
+        manager.enqueue(rx_sms)
+        if i % 500 == 499:
+            sink.wait(i + 1)
+    return op, sink.close
+
+
+def _concat_pool():
+    from msgbox.worker import ConcatPool
+    _start_forwarder()
+    pool = ConcatPool()
+    pool.start()
+    return pool
+
+
+@benchmark(50000)
+def concat_pool_merge(n):
+    # 3-part sms: two segments out of three only update the pool
+    pool = _concat_pool()
+    def op(i):
+        ref, number = divmod(i, 3)
+        pool.merge(_segment('+39333%07d' % (ref % 1000), ref % 256, 3,
+                            number + 1))
+    return op, pool.stop
+
+
+@benchmark(50000)
+def concat_pool_expiry(n):
+    # partial sms expire right away: the pool thread forwards them
+    pool = _concat_pool()
+    pool.CONCAT_TIMEOUT = 0
+    def op(i):
+        pool.merge(_segment('+39333%07d' % i, i % 256, 2, 1))
+        if i % 500 == 499:
+            while pool.stats['entries']:
+                time.sleep(.001)
+    return op, pool.stop
+
+
+@benchmark(50000)
+def concat_pool_evict(n):
+    # a full pool: every new partial sms evicts the oldest one
+    pool = _concat_pool()
+    pool.MAX_ENTRIES = 1000
+    def op(i):
+        pool.merge(_segment('+39333%07d' % i, i % 256, 2, 1))
+    return op, pool.stop
+
+
+def _sim_manager(n_sims, pool=None):
+    from msgbox.sim import SimManager, SimConfigDB
+    manager = SimManager()
+    manager.sim_config_db = db = SimConfigDB()
+    workers = []
+    for i in xrange(n_sims):
+        imsi = '00101%010d' % i
+        if imsi not in db:
+            db.add(imsi)
+        changes = dict(phone_number='+39000%07d' % i)
+        if pool is not None:
+            changes['pool'] = pool
+        db.update(imsi, **changes)
+        worker = BenchActor('/dev/bench%d' % i, imsi)
+        manager.register(worker)
+        worker.drain()
+        workers.append(worker)
+    return manager, workers
+
+
+@benchmark(100000)
+def sim_manager_route_sender(n):
+    from msgbox.sim import TxSmsReq
+    manager, workers = _sim_manager(10)
+    def op(i):
+        manager.route(TxSmsReq('+39000%07d' % (i % 10), '+393331234567',
+                               'hi', None, None, _noop))
+        if i % 1000 == 999:
+            for worker in workers:
+                worker.drain()
+    return op, _noop
+
+
+@benchmark(100000)
+def sim_manager_route_pool(n):
+    from msgbox.sim import TxSmsReq
+    manager, workers = _sim_manager(10, pool='bench')
+    def op(i):
+        manager.route(TxSmsReq(None, '+393331234567', 'hi', None, None,
+                               _noop, pool='bench'))
+        if i % 1000 == 999:
+            for worker in workers:
+                worker.drain()
+    return op, _noop
+
+
+@benchmark(500000)
+def convert_to_international_local(n):
+    from msgbox.util import convert_to_international
+    def op(i):
+        convert_to_international('3331234567', '+393359609600')
+    return op, _noop
+
+
+@benchmark(500000)
+def convert_to_international_already(n):
+    from msgbox.util import convert_to_international
+    def op(i):
+        convert_to_international('+393331234567', '+393359609600')
+    return op, _noop
+
+
+@benchmark(50000)
+def http_client_enqueue(n):
+    # beyond MAX_IN_MEMORY received sms only go to the spool on disk
+    from msgbox.http import http_client_manager
+    _start_forwarder()
+    rx_sms = dict(sender='+393331234567', recipient='+393480000000',
+                  text='x' * 153, tstamp='2014-01-01 00:00:00',
+                  url='http://localhost/')
+    def op(i):
+        http_client_manager.enqueue(rx_sms)
+    return op, _noop
+
+
+def percentile(sorted_samples, p):
+    return sorted_samples[min(int(len(sorted_samples) * p),
+                              len(sorted_samples) - 1)]
+
+
+def _timer_overhead():
+    """Secs taken by a pair of timer() calls, taken off each sample."""
+    best = float('inf')
+    for _ in xrange(1000):
+        t0 = timer()
+        best = min(best, timer() - t0)
+    return best
+
+
+def run(n, fun, warmup, n_samples, n_chunks=10):
+    """Time `n` ops in `n_chunks` loops for the throughput, then
+    `n_samples` more ops one by one for the latency percentiles.
+
+    The throughput is the one of the median chunk: the box stealing the
+    cpu for a while only slows down a few chunks.
+    """
+    random.seed(0)
+    try:
+        op, teardown = fun(warmup + n + n_samples)
+    except (ImportError, AttributeError, TypeError), e:
+        raise NotAvailable(e)
+    try:
+        for i in xrange(warmup):
+            op(i)
+        gc.collect()
+        n_objects = len(gc.get_objects())
+        bounds = [warmup + n * k / n_chunks for k in xrange(n_chunks + 1)]
+        rates = []
+        for lo, hi in zip(bounds, bounds[1:]):
+            start = timer()
+            for i in xrange(lo, hi):
+                op(i)
+            rates.append((hi - lo) / max(timer() - start, 1e-9))
+        n_objects = len(gc.get_objects()) - n_objects
+        overhead = _timer_overhead()
+        samples = [0.] * n_samples
+        base = warmup + n
+        for i in xrange(n_samples):
+            t0 = timer()
+            op(base + i)
+            samples[i] = max(timer() - t0 - overhead, 0.)
+    finally:
+        teardown()
+    samples.sort()
+    rates.sort()
+    return dict(n=n,
+                ops_per_sec=rates[len(rates) / 2],
+                p50_us=percentile(samples, .50) * 1e6,
+                p90_us=percentile(samples, .90) * 1e6,
+                p99_us=percentile(samples, .99) * 1e6,
+                max_us=samples[-1] * 1e6,
+                objs_per_op=float(n_objects) / n)
+
+
+HEADER = '%-34s %11s %9s %9s %9s %9s %8s' % ('benchmark', 'ops/s', 'p50 us',
+                                            'p90 us', 'p99 us', 'max us',
+                                            'objs/op')
+
+def format_result(name, r):
+    return '%-34s %11.0f %9.2f %9.2f %9.2f %9.1f %8.3f' % (
+                name, r['ops_per_sec'], r['p50_us'], r['p90_us'],
+                r['p99_us'], r['max_us'], r['objs_per_op'])
+
+
+def compare(results, baseline, threshold):
+    """Print the changes against `baseline`. Return the regressed names."""
+    regressions = []
+    print
+    print '%-34s %11s %11s %9s %9s' % ('benchmark', 'base ops/s', 'ops/s',
+                                       'delta', 'p99 delta')
+    for name, r in sorted(results.iteritems()):
+        base = baseline.get(name)
+        if base is None:
+            print '%-34s %11s %11.0f' % (name, '-', r['ops_per_sec'])
+            continue
+        delta = r['ops_per_sec'] / base['ops_per_sec'] - 1
+        p99_delta = r['p99_us'] / max(base['p99_us'], 1e-3) - 1
+        flag = ''
+        if delta < -threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print '%-34s %11.0f %11.0f %+8.1f%% %+8.1f%%%s' % (
+                    name, base['ops_per_sec'], r['ops_per_sec'],
+                    delta * 100, p99_delta * 100, flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='msgbox microbenchmarks')
+    parser.add_argument('-k', '--filter', default='',
+                        help='run only the benchmarks containing FILTER')
+    parser.add_argument('--scale', type=float, default=1.,
+                        help='scale the number of operations')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per benchmark, the fastest is kept '
+                             '(default: 3)')
+    parser.add_argument('--samples', type=int, default=10000,
+                        help='ops timed one by one for the latency '
+                             'percentiles (default: 10000)')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as a json baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with a json baseline')
+    parser.add_argument('--threshold', type=float, default=.1,
+                        help='throughput drop flagged as regression '
+                             '(default: 0.1)')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    results = {}
+    print HEADER
+    try:
+        for name, n, fun in BENCHMARKS:
+            if args.filter not in name:
+                continue
+            n = max(int(n * args.scale), 1)
+            try:
+                # the fastest run is the least disturbed by the rest of
+                # the box
+                r = max((run(n, fun, warmup=min(n / 10, 1000),
+                             n_samples=min(n, args.samples))
+                         for _ in xrange(args.repeat)),
+                        key=lambda r: r['ops_per_sec'])
+            except NotAvailable, e:
+                print '%-34s %11s  (%s)' % (name, 'n/a', e)
+                continue
+            results[name] = r
+            print format_result(name, r)
+            sys.stdout.flush()
+    finally:
+        _stop_forwarder()
+        shutil.rmtree(SCRATCH_HOME, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, 'w') as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fin:
+            baseline = json.load(fin)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
+import itertools
 import logging
 import time
 import threading
-from Queue import Queue, Empty
+from collections import deque
+from Queue import Empty
 
 
 logger = logging.getLogger('actor')
@@ -22,18 +24,170 @@ class Timeout(Message):
 
 class RejectedMsgException(Exception):
 
-    def __init__(self, msg):
+    def __init__(self, msg, retry_after=None):
         self.msg = msg
+        # secs after which the sender may try again (None: never)
+        self.retry_after = retry_after
+
+
+class Mailbox(object):
+    """Message queue supporting constant time selective receive.
+
+    Messages are kept in one deque per message class. A sequence number
+    preserves the global arrival order across the deques: a receive
+    picks the oldest head among the deques matching the requested type.
+    Msgs of `bounded_msgs` type(s) are counted apart, for the size limit.
+    """
+
+    def __init__(self, bounded_msgs=Message):
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+        self.deques = {}    # {msg class: deque([(seq, tstamp, msg), ...])}
+        self._matching = {} # {typ: [msg class, ...]}
+        self._seq = itertools.count()
+        self._size = 0
+        self.bounded_msgs = bounded_msgs
+        self._bounded_size = 0
+
+    def qsize(self):
+        return self._size
+
+    def bounded_qsize(self):
+        return self._bounded_size
+
+    def put(self, msg):
+        with self.mutex:
+            cls = type(msg)
+            dq = self.deques.get(cls)
+            if dq is None:
+                dq = self.deques[cls] = deque()
+                self._matching = {}
+            dq.append((next(self._seq), time.time(), msg))
+            self._size += 1
+            if isinstance(msg, self.bounded_msgs):
+                self._bounded_size += 1
+            self.not_empty.notify()
+
+    def get(self, typ=None, block=True, timeout=None):
+        """Pop the oldest msg of type `typ` (any type if None).
+
+        Raise Empty if no such msg shows up in time.
+        """
+        with self.mutex:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while True:
+                dq = self._oldest(typ)
+                if dq is not None:
+                    return self._pop(dq)
+                if not block:
+                    raise Empty()
+                if timeout is None:
+                    self.not_empty.wait()
+                else:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        raise Empty()
+                    self.not_empty.wait(left)
+
+    def get_next(self, typ):
+        """Pop the oldest msg if it is of type `typ`: unlike get, msgs
+        of other types queued before are not overtaken.
+
+        Raise Empty otherwise.
+        """
+        with self.mutex:
+            dq = self._oldest(None)
+            if dq is None or not isinstance(dq[0][2], typ):
+                raise Empty()
+            return self._pop(dq)
+
+    def has(self, typ):
+        """Whether a msg of type `typ` is queued."""
+        with self.mutex:
+            return self._oldest(typ) is not None
+
+    def wait_for_room(self, maxsize, deadline):
+        """Wait until less than `maxsize` bounded msgs are queued or
+        `deadline`.
+
+        Return False on timeout.
+        """
+        with self.mutex:
+            while self._bounded_size >= maxsize:
+                left = deadline - time.time()
+                if left <= 0:
+                    return False
+                self.not_full.wait(left)
+        return True
+
+    @property
+    def stats(self):
+        """Return depth and age (secs) of the oldest msg, total and per
+        msg class."""
+        with self.mutex:
+            now = time.time()
+            by_type = {}
+            oldest = None
+            for cls, dq in self.deques.iteritems():
+                if not dq:
+                    continue
+                seq, tstamp, _ = dq[0]
+                by_type[cls.__name__] = dict(depth=len(dq),
+                                             oldest_age=now - tstamp)
+                if oldest is None or seq < oldest[0]:
+                    oldest = seq, tstamp
+            return dict(depth=self._size,
+                        oldest_age=now - oldest[1] if oldest else 0.,
+                        by_type=by_type)
+
+    def _pop(self, dq):
+        _, _, msg = dq.popleft()
+        self._size -= 1
+        if isinstance(msg, self.bounded_msgs):
+            self._bounded_size -= 1
+            self.not_full.notify()
+        return msg
+
+    def _oldest(self, typ):
+        if typ is None:
+            candidates = self.deques.itervalues()
+        else:
+            candidates = self._matching.get(typ)
+            if candidates is None:
+                candidates = self._matching[typ] = [
+                    dq for cls, dq in self.deques.iteritems()
+                       if issubclass(cls, typ)]
+        oldest = None
+        for dq in candidates:
+            if dq and (oldest is None or dq[0][0] < oldest[0][0]):
+                oldest = dq
+        return oldest
 
 
 class Actor(object):
 
-    def __init__(self, name, daemon=False):
+    # rough secs needed to process a message: used to hint rejected
+    # senders when to retry
+    SERVICE_TIME = 0.01
+    # how long a sender waits for room with the 'block' overflow policy
+    BLOCK_TIMEOUT = 5
+
+    def __init__(self, name, daemon=False, maxsize=0, overflow='reject',
+                 bounded_msgs=Message):
+        """Mailbox holds at most `maxsize` msgs of `bounded_msgs` type(s)
+        (0: no limit). On overflow `send` either raises
+        RejectedMsgException ('reject') or waits for room ('block').
+        """
+        assert overflow in ('reject', 'block')
         self.thread = threading.Thread(name=name, target=self._run)
         self.thread.daemon = daemon
-        self.queue = Queue()
-        self.unprocessed = []
+        self.mailbox = Mailbox(bounded_msgs)
         self.mutex = threading.Lock()
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.bounded_msgs = bounded_msgs
         self._acceptable_msgs = None
 
     def start(self):
@@ -44,7 +198,7 @@ class Actor(object):
         self.run()
         with self.mutex:
             self._acceptable_msgs = ()
-        unprocessed = list(self.unprocessed)
+        unprocessed = []
         while True:
             msg = self.receive(block=False)
             if isinstance(msg, Timeout):
@@ -59,35 +213,17 @@ class Actor(object):
         raise NotImplementedError()
 
     def receive(self, typ=None, block=True, timeout=None):
-        msg = self._check_unprocessed(typ)
-        if msg is not None:
-            return msg
-
-        if timeout is not None:
-            deadline = time.time() + timeout
-        left = timeout
-        while left is None or left > 0:
-            try:
-                msg = self.queue.get(block=block, timeout=left)
-            except Empty:
-                return Timeout()
-            if typ is None or isinstance(msg, typ):
-                return msg
-            else:
-                self.unprocessed.append(msg)
-                if timeout is not None:
-                    left = deadline - time.time()
+        try:
+            return self.mailbox.get(typ, block=block, timeout=timeout)
+        except Empty:
+            return Timeout()
 
-    def _check_unprocessed(self, typ):
-        unprocessed = self.unprocessed
-        if typ is None:
-            if unprocessed:
-                return unprocessed.pop(0)
-        else:
-            for i, msg in enumerate(unprocessed):
-                if isinstance(msg, typ):
-                    return unprocessed.pop(i)
-        return None
+    def receive_next(self, typ):
+        """Return the oldest msg if it is a `typ`, Timeout otherwise."""
+        try:
+            return self.mailbox.get_next(typ)
+        except Empty:
+            return Timeout()
 
     def accept_only(self, types):
         with self.mutex:
@@ -100,13 +236,31 @@ class Actor(object):
     def close_channel(self):
         with self.mutex:
             self._acceptable_msgs = ()
-            self.queue.put(ChannelClosed())
+            self.mailbox.put(ChannelClosed())
+
+    @property
+    def is_full(self):
+        return 0 < self.maxsize <= self.mailbox.bounded_qsize()
+
+    @property
+    def expected_wait(self):
+        """Estimated secs before a msg sent now would be processed."""
+        return (self.mailbox.qsize() + 1) * self.SERVICE_TIME
 
     def send(self, msg):
         if not isinstance(msg, Message):
             raise ValueError('%s is not a Message instance' % msg)
-        with self.mutex:
-            if self._acceptable_msgs is not None:
-                if not isinstance(msg, self._acceptable_msgs):
-                    raise RejectedMsgException(msg)
-            self.queue.put(msg)
+        bounded = self.maxsize > 0 and isinstance(msg, self.bounded_msgs)
+        deadline = time.time() + self.BLOCK_TIMEOUT
+        while True:
+            with self.mutex:
+                if self._acceptable_msgs is not None:
+                    if not isinstance(msg, self._acceptable_msgs):
+                        raise RejectedMsgException(msg)
+                if not (bounded and self.is_full):
+                    self.mailbox.put(msg)
+                    return
+                if self.overflow == 'reject':
+                    raise RejectedMsgException(msg, self.expected_wait)
+            if not self.mailbox.wait_for_room(self.maxsize, deadline):
+                raise RejectedMsgException(msg, self.expected_wait)
@@ -0,0 +1,116 @@
+import json
+import os
+import re
+import time
+from threading import Lock
+
+from msgbox import logger
+from msgbox.journal import _makedirs
+
+
+DEVICE_CACHE_FILE = os.path.expanduser('~/.msgbox/devices.json')
+
+
+_VID_PID_RE = re.compile(r'VID:PID=([0-9A-Fa-f]+):([0-9A-Fa-f]+)')
+_SERIAL_RE = re.compile(r'(?:SER|SNR)=(\S+)')
+_LOCATION_RE = re.compile(r'LOCATION=\S+:(\S+)')
+
+
+def device_key(serial_info):
+    """Identity of the device behind a serial port, stable across
+    reboots and re-plugs: "VID:PID:SER:interface" for usb devices.
+
+    Without usb serial number or interface the device path stands in
+    for them. Non usb ports are identified by their path.
+    """
+    hw = serial_info.hw or ''
+    match = _VID_PID_RE.search(hw)
+    if match is None:
+        return 'dev:%s' % serial_info.dev
+    vid, pid = match.group(1).lower(), match.group(2).lower()
+    serial = _SERIAL_RE.search(hw)
+    interface = _LOCATION_RE.search(hw)
+    if serial is None or interface is None:
+        # several ports of the same device can't be told apart
+        return '%s:%s:%s:%s' % (vid, pid, serial.group(1) if serial else '',
+                                serial_info.dev)
+    return '%s:%s:%s:%s' % (vid, pid, serial.group(1), interface.group(1))
+
+
+class DeviceCache(object):
+    """What has been learned about serial devices, kept on disk.
+
+    Entries are dicts keyed by `device_key`; fields:
+        modem:    whether a modem answered on the port
+        probed:   when `modem` was established (epoch secs)
+        baudrate: rate the modem answered at
+        imsi, modem_info: identity of the modem (and its sim) last seen
+    """
+
+    # known non-modems are probed again after that many secs
+    NON_MODEM_TTL = 24 * 3600
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.entries = {}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as fin:
+                self.entries = json.load(fin)
+        except ValueError:
+            logger.warn('device cache %s corrupted: ignored', self.path)
+            return
+        logger.info('device cache: %d known device(s)', len(self.entries))
+
+    def get(self, key):
+        with self.lock:
+            return dict(self.entries.get(key, {}))
+
+    def update(self, key, **fields):
+        with self.lock:
+            entry = self.entries.setdefault(key, {})
+            if all(entry.get(k) == v for k, v in fields.iteritems()):
+                return
+            entry.update(fields)
+            self._save()
+
+    def probed(self, key, modem):
+        self.update(key, modem=modem, probed=time.time())
+
+    def is_non_modem(self, key):
+        entry = self.get(key)
+        return (entry.get('modem') is False and
+                time.time() - entry['probed'] < self.NON_MODEM_TTL)
+
+    def is_modem(self, key):
+        return self.get(key).get('modem') is True
+
+    def forget_non_modems(self, key=None):
+        """Drop the entry of `key` (of every device if None) if it is a
+        known non-modem: it is probed again at next port scan.
+
+        Return the number of entries dropped.
+        """
+        with self.lock:
+            keys = [k for k, entry in self.entries.iteritems()
+                      if entry.get('modem') is False and
+                         key in (None, k)]
+            for k in keys:
+                del self.entries[k]
+            if keys:
+                self._save()
+        return len(keys)
+
+    def _save(self):
+        _makedirs(os.path.dirname(self.path))
+        tmp_file = self.path + '.tmp'
+        with open(tmp_file, 'w') as fout:
+            json.dump(self.entries, fout, indent=2, sort_keys=True)
+        os.rename(tmp_file, self.path)
+
+
+device_cache = DeviceCache(DEVICE_CACHE_FILE)
@@ -0,0 +1,103 @@
+import unicodedata
+from collections import namedtuple
+
+from gsmmodem.pdu import GSM7_BASIC, GSM7_EXTENDED
+
+
+# max septets (gsm7) or utf-16 code units (ucs2) per sms part
+GSM7_SINGLE, GSM7_MULTI = 160, 153
+UCS2_SINGLE, UCS2_MULTI = 70, 67
+
+# 'keep':        send the text as is
+# 'fewer_parts': transliterate when that saves parts
+# 'gsm7':        transliterate whenever that makes the text gsm7
+POLICIES = ('keep', 'fewer_parts', 'gsm7')
+
+LOOKALIKES = {
+    # quotes
+    u'\u2018': u"'", u'\u2019': u"'", u'\u201a': u"'", u'\u201b': u"'",
+    u'\u2032': u"'", u'\u00b4': u"'",
+    u'\u201c': u'"', u'\u201d': u'"', u'\u201e': u'"', u'\u201f': u'"',
+    u'\u2033': u'"', u'\u00ab': u'"', u'\u00bb': u'"',
+    # dashes and bullets
+    u'\u2010': u'-', u'\u2011': u'-', u'\u2012': u'-', u'\u2013': u'-',
+    u'\u2014': u'-', u'\u2015': u'-', u'\u2212': u'-', u'\u2022': u'-',
+    # ellipsis and spaces
+    u'\u2026': u'...', u'\u00a0': u' ', u'\u2009': u' ', u'\u202f': u' ',
+    u'\u200b': u'',    u'\ufeff': u'',  u'\t':     u' ',
+}
+
+
+SmsPlan = namedtuple('SmsPlan', ['text', 'encoding', 'parts'])
+
+
+def _width(char):
+    """Septets taken by `char` in gsm7 (None if not encodable)."""
+    if char in GSM7_BASIC:
+        return 1
+    if char in GSM7_EXTENDED:
+        return 2
+    return None
+
+
+def _count_parts(widths, single, multi):
+    if sum(widths) <= single:
+        return 1
+    parts, used = 1, 0
+    for w in widths:
+        # escape sequences and surrogate pairs are never split
+        if used + w > multi:
+            parts += 1
+            used = 0
+        used += w
+    return parts
+
+
+def _plan(text):
+    widths = [_width(c) for c in text]
+    if None not in widths:
+        return SmsPlan(text, 'gsm7', _count_parts(widths, GSM7_SINGLE,
+                                                          GSM7_MULTI))
+    widths = [2 if ord(c) > 0xffff else 1 for c in text]
+    return SmsPlan(text, 'ucs2', _count_parts(widths, UCS2_SINGLE,
+                                                      UCS2_MULTI))
+
+
+def transliterate(text):
+    """Replace the chars outside gsm7 with gsm7 look-alikes, if any."""
+    chars = []
+    for c in text:
+        if _width(c) is None:
+            if c in LOOKALIKES:
+                c = LOOKALIKES[c]
+            else:
+                # drop accents, e.g. a with acute accent -> a
+                base = u''.join(b for b in unicodedata.normalize('NFKD', c)
+                                  if not unicodedata.combining(b))
+                if base and None not in map(_width, base):
+                    c = base
+        chars.append(c)
+    return u''.join(chars)
+
+
+def plan_sms(text, policy='keep'):
+    """Return the SmsPlan for `text` under transliteration `policy`.
+
+    Raise ValueError for an unknown policy, TypeError if `text` is not
+    a string.
+    """
+    if policy not in POLICIES:
+        raise ValueError('unknown encoding policy %r' % (policy,))
+    if not isinstance(text, basestring):
+        raise TypeError('sms text must be a string, not %r' % (text,))
+    if not isinstance(text, unicode):
+        text = text.decode('utf8')
+    plan = _plan(text)
+    if policy == 'keep' or plan.encoding == 'gsm7':
+        return plan
+    alt_plan = _plan(transliterate(text))
+    if alt_plan.encoding != 'gsm7':
+        return plan
+    if policy == 'fewer_parts' and alt_plan.parts >= plan.parts:
+        return plan
+    return alt_plan
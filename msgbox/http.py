@@ -1,3 +1,8 @@
+import json
+import math
+import os
+import random
+import sys
 import time
 import urllib
 import urllib2
@@ -7,14 +12,31 @@ from threading import Thread, Lock
 
 import tornado.httpserver
 import tornado.ioloop
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
 from tornado.web import HTTPError, RequestHandler, Application, asynchronous
 
 from msgbox import logger
-from msgbox.sim import sim_manager, TxSmsReq
+from msgbox.actor import RejectedMsgException
+from msgbox.devices import device_cache
+from msgbox.journal import Spool
+from msgbox.metrics import registry
+from msgbox.sim import sim_manager, TxSmsReq, UpdateSimConfig
+from msgbox.util import status, unique_id, TimerHeap
+
+
+RX_SPOOL_FILE = os.path.expanduser('~/.msgbox/rx_sms.spool')
+RX_DEAD_LETTER_FILE = os.path.expanduser('~/.msgbox/rx_sms.dead')
 
 
 ioloop = tornado.ioloop.IOLoop.instance()
 
+# set_status needs the reason of the codes unknown to httplib (429)
+REASONS = {
+    400: 'Bad Request',
+    429: 'Too Many Requests',
+    503: 'Service Unavailable',
+}
+
 
 # application/x-www-form-urlencoded
 # params:
@@ -22,6 +44,7 @@ ioloop = tornado.ioloop.IOLoop.instance()
 #   recipient: "+393482222222"
 #   sender:    "+393481111111"
 #   imsi:      "21312123232"
+#   pool:      "bulk"
 #   text:      "sms text"
 
 class MTHandler(RequestHandler):
@@ -32,14 +55,180 @@ class MTHandler(RequestHandler):
         recipient = self.get_argument('recipient')
         text      = self.get_argument('text')
         imsi      = self.get_argument('imsi', None)
+        pool      = self.get_argument('pool', None)
         key       = self.get_argument('key', None)
 
-        if not ((sender is None) ^ (imsi is None)):
-            err_msg = 'Use either "sender" or "imsi" params'
+        if [sender, imsi, pool].count(None) != 2:
+            err_msg = 'Use one of "sender", "imsi" or "pool" params'
+            raise HTTPError(400, err_msg)
+
+        tx_sms = TxSmsReq(sender, recipient, text, imsi, key,
+                          callback=self.reply_callback, pool=pool)
+        try:
+            sim_manager.accept(tx_sms)
+        except RejectedMsgException, e:
+            # the gateway as a whole is overloaded
+            self.handle_reply(status('ERROR', '%s: overloaded' % tx_sms,
+                                     retry_after=e.retry_after, code=503))
+
+    def reply_callback(self, response_dict):
+        ioloop.add_callback(partial(self.handle_reply, response_dict))
+
+    def handle_reply(self, response_dict):
+        log_method = logger.warn if response_dict['status'] == 'ERROR' else \
+                     logger.info
+        log_method(response_dict['desc'])
+        # 503 when the gateway as a whole is overloaded, 429 when it's the
+        # sim the request was routed to that can't keep up
+        code = response_dict.pop('code', 429)
+        retry_after = response_dict.get('retry_after')
+        if retry_after is not None:
+            self.set_status(code, REASONS[code])
+            self.set_header('Retry-After', max(1, int(math.ceil(retry_after))))
+        self.write(response_dict)
+        self.finish()
+
+
+# application/json
+# body:
+#   {"sender":   "+393481111111",   (one of sender, imsi, pool)
+#    "key":      "asds7878",        (optional)
+#    "messages": [{"recipient": "+393482222222", "text": "sms text"}, ...]}
+# response: one json line per message, in completion order
+#   {"index": 0, "recipient": "+393482222222", "status": "OK", "desc": ..}
+
+class MTBatchHandler(RequestHandler):
+
+    MAX_MESSAGES = 10000
+
+    @asynchronous
+    def post(self):
+        try:
+            body = json.loads(self.request.body)
+            messages = body['messages']
+            assert isinstance(messages, list)
+        except Exception:
+            raise HTTPError(400, 'Invalid json body')
+        sender = body.get('sender')
+        imsi   = body.get('imsi')
+        pool   = body.get('pool')
+        key    = body.get('key')
+
+        if [sender, imsi, pool].count(None) != 2:
+            err_msg = 'Use one of "sender", "imsi" or "pool" params'
+            raise HTTPError(400, err_msg)
+        if len(messages) > self.MAX_MESSAGES:
+            raise HTTPError(400, 'Too many messages (max %d)' %
+                                 self.MAX_MESSAGES)
+        try:
+            pairs = [(m['recipient'], m['text']) for m in messages]
+        except (KeyError, TypeError):
+            raise HTTPError(400, 'Use "recipient" and "text" in messages')
+
+        self.set_header('Content-Type', 'application/x-ndjson')
+        self._pending = len(pairs)
+        self._closed = False
+        if not pairs:
+            self.finish()
+        for index, (recipient, text) in enumerate(pairs):
+            # stripped strings, as get_argument gives /send_sms
+            if not all(isinstance(v, basestring) and v.strip()
+                       for v in (recipient, text)):
+                err_msg = ('message %d: "recipient" and "text" must be '
+                           'non-empty strings' % index)
+                self.handle_reply(index, recipient, status('ERROR', err_msg))
+                continue
+            recipient, text = recipient.strip(), text.strip()
+            callback = partial(self.reply_callback, index, recipient)
+            tx_sms = TxSmsReq(sender, recipient, text, imsi, key,
+                              callback=callback, pool=pool)
+            try:
+                sim_manager.accept(tx_sms)
+            except RejectedMsgException, e:
+                self.handle_reply(index, recipient,
+                                  status('ERROR', '%s: overloaded' % tx_sms,
+                                         retry_after=e.retry_after, code=503))
+
+    def reply_callback(self, index, recipient, response_dict):
+        ioloop.add_callback(partial(self.handle_reply, index, recipient,
+                                    response_dict))
+
+    def handle_reply(self, index, recipient, response_dict):
+        log_method = logger.warn if response_dict['status'] == 'ERROR' else \
+                     logger.info
+        log_method(response_dict['desc'])
+        self._pending -= 1
+        if self._closed:
+            return
+        line = dict(response_dict, index=index, recipient=recipient)
+        line.pop('code', None)
+        self.write(json.dumps(line) + '\n')
+        if self._pending:
+            self.flush()
+        else:
+            self.finish()
+
+    def on_connection_close(self):
+        self._closed = True
+
+
+class ReplayDeadLettersHandler(RequestHandler):
+
+    def post(self):
+        n = http_client_manager.replay_dead_letters()
+        desc = '%d dead letter(s) queued for forwarding' % n
+        logger.info(desc)
+        self.write(status('OK', desc))
+
+
+class ForgetNonModemsHandler(RequestHandler):
+    """Have the ports known as non-modems probed again at next scan.
+
+    params: key: device key (default: all the devices)
+    """
+
+    def post(self):
+        n = device_cache.forget_non_modems(self.get_argument('key', None))
+        desc = '%d non-modem device(s) forgotten' % n
+        logger.info(desc)
+        self.write(status('OK', desc))
+
+
+# application/x-www-form-urlencoded
+# params:
+#   imsi:         "21312123232"
+#   phone_number: "+393481111111"           (optional)
+#   url:          "http://host/rx_sms"      (optional)
+#   active:       "true" / "false"          (optional)
+
+class SimConfigHandler(RequestHandler):
+
+    FIELDS = ('phone_number', 'url')
+
+    @asynchronous
+    def post(self):
+        imsi = self.get_argument('imsi')
+        changes = {}
+        for field in self.FIELDS:
+            value = self.get_argument(field, None)
+            if value is not None:
+                if not value:
+                    raise HTTPError(400, '"%s" can\'t be blank' % field)
+                changes[field] = value
+        active = self.get_argument('active', None)
+        if active is not None:
+            if active.lower() not in ('true', 'false', '1', '0'):
+                raise HTTPError(400, 'Use "true" or "false" for "active"')
+            changes['active'] = active.lower() in ('true', '1')
+        if not changes:
+            err_msg = 'Use at least one of "phone_number", "url" or "active"'
             raise HTTPError(400, err_msg)
 
-        sim_manager.send(TxSmsReq(sender, recipient, text, imsi, key,
-                                  callback=self.reply_callback))
+        try:
+            sim_manager.send(UpdateSimConfig(imsi, changes,
+                                             self.reply_callback))
+        except RejectedMsgException:
+            self.handle_reply(status('ERROR', 'shutting down'))
 
     def reply_callback(self, response_dict):
         ioloop.add_callback(partial(self.handle_reply, response_dict))
@@ -48,25 +237,77 @@ class MTHandler(RequestHandler):
         log_method = logger.warn if response_dict['status'] == 'ERROR' else \
                      logger.info
         log_method(response_dict['desc'])
+        code = response_dict.pop('code', None)
+        if code is not None:
+            self.set_status(code, REASONS[code])
         self.write(response_dict)
         self.finish()
 
 
+class TracesHandler(RequestHandler):
+    """Latest traces of answered sms tx requests, newest first.
+
+    params: limit (default 100), min_ms: only traces slower than that.
+    Empty unless msgbox runs with --trace.
+    """
+
+    def get(self):
+        try:
+            limit = int(self.get_argument('limit', 100))
+            min_ms = float(self.get_argument('min_ms', 0))
+        except ValueError:
+            raise HTTPError(400, 'Invalid "limit" or "min_ms" param')
+        traces = []
+        for trace in reversed(list(sim_manager.traces)):
+            if len(traces) >= limit:
+                break
+            if trace['total_ms'] >= min_ms:
+                traces.append(trace)
+        self.write(dict(traces=traces))
+
+
+class MetricsHandler(RequestHandler):
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(registry.render())
+
+
 class HTTPServerManager(object):
+    """The public api on `port`, the admin and debug handlers on
+    `admin_port`, bound to localhost as they are not authenticated.
+    """
 
-    def __init__(self, port=8080):
-        app = Application([
+    def __init__(self, port=8080, admin_port=8081):
+        self.app = Application([
             (r"/send_sms", MTHandler),
+            (r"/send_sms_batch", MTBatchHandler),
+            (r"/metrics", MetricsHandler),
+        ])
+        self.admin_app = Application([
+            (r"/replay_dead_letters", ReplayDeadLettersHandler),
+            (r"/admin/sim_config", SimConfigHandler),
+            (r"/admin/forget_non_modems", ForgetNonModemsHandler),
+            (r"/debug/traces", TracesHandler),
         ])
         self.port = port
-        self.http_server = tornado.httpserver.HTTPServer(app)
+        self.admin_port = admin_port
+        self.http_server = tornado.httpserver.HTTPServer(self.app)
+        self.admin_server = tornado.httpserver.HTTPServer(self.admin_app)
+
+    def add_handlers(self, handlers, admin=False):
+        app = self.admin_app if admin else self.app
+        app.add_handlers(r'.*$', handlers)
 
     def start(self):
-        logger.info('http listening on port %s', self.port)
+        logger.info('http listening on port %s, admin on 127.0.0.1:%s',
+                    self.port, self.admin_port)
         self.http_server.listen(self.port)
+        self.admin_server.listen(self.admin_port, address='127.0.0.1')
 
     def stop(self):
         self.http_server.stop()
+        self.admin_server.stop()
 
 
 http_server_manager = HTTPServerManager()
@@ -77,19 +318,101 @@ http_server_manager = HTTPServerManager()
 class HTTPClientManagerStoppingError(Exception): pass
 
 
+MO_FORWARD_SECONDS = registry.histogram('msgbox_mo_forward_seconds',
+                                        'duration of the forwarding requests')
+MO_FORWARDED = registry.counter('msgbox_mo_forwarded_total',
+                                'received sms forwarded')
+MO_RETRIES = registry.counter('msgbox_mo_forward_retries_total',
+                              'forwarding requests scheduled for retry')
+MO_GIVE_UPS = registry.counter('msgbox_mo_forward_give_ups_total',
+                               'received sms moved to the dead letters')
+
+
+class Delivery(object):
+    """One http request to a webhook: a single sms or a batch of them."""
+
+    def __init__(self, url, batch=False):
+        self.url = url
+        self.batch = batch
+        self.msgs = []  # [(id, msg_dict), ...]
+        self.attempt = 0
+
+    def __len__(self):
+        return len(self.msgs)
+
+    def add(self, id, msg_dict):
+        self.msgs.append((id, msg_dict))
+
+    @property
+    def request(self):
+        """Return url, body and headers of the http request."""
+        if self.batch:
+            data = [_payload(msg_dict) for _, msg_dict in self.msgs]
+            return self.url, json.dumps(data), {
+                'Content-Type': 'application/json'}
+        else:
+            [(_, msg_dict)] = self.msgs
+            data = dict((k, _utf8(v))
+                        for k, v in _payload(msg_dict).iteritems())
+            return self.url, urllib.urlencode(data), {
+                'Content-Type': 'application/x-www-form-urlencoded'}
+
+
+def _payload(msg_dict):
+    return dict((k, v) for k, v in msg_dict.iteritems()
+                       if k not in ('url', 'batch'))
+
+
 class HTTPClientManager(object):
 
+    # 'thread': blocking urllib2 requests on `concurrency` threads
+    # 'async':  non blocking requests on the tornado ioloop
+    MODES = ('thread', 'async')
     N_WORKERS = 10
+    TIMEOUT = 20
+    MAX_ATTEMPTS = 3
+    # retry delay doubles at every attempt (jittered by up to -50%)
+    RETRY_BASE = 10
+    RETRY_MAX = 300
+    # received sms kept in memory; the others wait in the spool on disk
+    MAX_IN_MEMORY = 1000
 
     def __init__(self):
         self.active = False
+        self.mode = 'thread'
+        self.concurrency = self.N_WORKERS
         self.workers = []
         self.queue = Queue()
         self.mutex = Lock()
+        self.scheduler = TimerHeap('HttpClient retries')
+        self.spool = Spool(RX_SPOOL_FILE)
+        self.dead_letters = Spool(RX_DEAD_LETTER_FILE)
+        self.http_client = None
+        self._in_flight = 0
+        self._loaded = set()
+        self._n_spilled = 0
+        self._refiller = None
+        self._batches = {}  # {url: Delivery(), ...} still lingering
+
+    def configure(self, mode=None, concurrency=None):
+        if mode is not None:
+            assert mode in self.MODES
+            self.mode = mode
+        if concurrency is not None:
+            self.concurrency = concurrency
 
     def start(self):
+        self.spool.open()
+        self.dead_letters.open()
+        self.scheduler.start()
+        self._n_spilled = len(self.spool)
         self.active = True
-        for i in xrange(self.N_WORKERS):
+        self._refill()
+        if self.mode == 'async':
+            self.http_client = self._make_async_client()
+            ioloop.add_callback(self._pump)
+            return
+        for i in xrange(self.concurrency):
             thread = Thread(name='HttpClient %d' % i, target=self._work)
             self.workers.append(thread)
             thread.start()
@@ -97,36 +420,193 @@ class HTTPClientManager(object):
     def stop(self):
         with self.mutex:
             self.active = False
+            refiller = self._refiller
+        if refiller is not None:
+            refiller.join()
+        self.scheduler.stop()
+        for thread in self.workers:
+            thread.join()
+        self.spool.close()
+        self.dead_letters.close()
+
+    def metrics(self):
+        return [
+            ('msgbox_mo_spooled', 'gauge',
+             'received sms waiting to be forwarded',
+             [({}, len(self.spool))]),
+            ('msgbox_mo_in_memory', 'gauge',
+             'received sms loaded in memory for forwarding',
+             [({}, len(self._loaded))]),
+            ('msgbox_mo_dead_letters', 'gauge',
+             'received sms given up on', [({}, len(self.dead_letters))]),
+        ]
+
+    def _make_async_client(self):
+        impl = None
+        try:
+            import pycurl
+        except ImportError:
+            # simple_httpclient opens a new connection for every request
+            logger.warn('pycurl not available: http keep-alive disabled')
+        else:
+            impl = 'tornado.curl_httpclient.CurlAsyncHTTPClient'
+        AsyncHTTPClient.configure(impl, max_clients=self.concurrency)
+        return AsyncHTTPClient()
 
     def _work(self):
-        while self.active or not self.queue.empty:
+        while self.active:
             try:
-                msg_dict = self.queue.get(timeout=2)
+                delivery = self.queue.get(timeout=2)
             except Empty:
                 continue
-            url = msg_dict.pop('url')
-            for attempt in xrange(3):
-                try:
-                    msg_dict['text'] = msg_dict['text'].encode('utf8')	
-                    data = urllib.urlencode(msg_dict)
-                    urllib2.urlopen(url, data, timeout=20)
-                    logger.info('forwarded sms - sender=%s recipient=%s',
-                                     msg_dict['sender'], msg_dict['recipient'])
-                    break
-                except Exception, e:
-                    logger.error('error while sending msg', exc_info=True)
-                time.sleep(10)
+            url, body, headers = delivery.request
+            start = time.time()
+            try:
+                request = urllib2.Request(url, body, headers)
+                urllib2.urlopen(request, timeout=self.TIMEOUT)
+            except Exception:
+                self._failed(delivery, sys.exc_info())
             else:
-                logger.error('giving up sending message %s', msg_dict,
-                                                             exc_info=1)
+                MO_FORWARD_SECONDS.labels().observe(time.time() - start)
+                self._forwarded(delivery)
+
+    def _pump(self):
+        while self.active and self._in_flight < self.concurrency:
+            try:
+                delivery = self.queue.get_nowait()
+            except Empty:
+                return
+            url, body, headers = delivery.request
+            request = HTTPRequest(url, method='POST', body=body,
+                                  headers=headers,
+                                  request_timeout=self.TIMEOUT)
+            self._in_flight += 1
+            self.http_client.fetch(request, partial(self._on_response,
+                                                    delivery))
+
+    def _on_response(self, delivery, response):
+        self._in_flight -= 1
+        if not self.active:
+            # left in the spool
+            return
+        if response.error:
+            error = response.error
+            self._failed(delivery, (type(error), error, None))
+        else:
+            MO_FORWARD_SECONDS.labels().observe(response.request_time)
+            self._forwarded(delivery)
+        self._pump()
+
+    def _put(self, delivery):
+        self.queue.put(delivery)
+        if self.mode == 'async':
+            ioloop.add_callback(self._pump)
+
+    def _forwarded(self, delivery):
+        for id, msg_dict in delivery.msgs:
+            logger.info('forwarded sms - sender=%s recipient=%s',
+                             msg_dict['sender'], msg_dict['recipient'])
+            MO_FORWARDED.labels().inc()
+            self._done(id)
+
+    def _failed(self, delivery, exc_info):
+        logger.error('error while sending msg', exc_info=exc_info)
+        delivery.attempt += 1
+        if delivery.attempt < self.MAX_ATTEMPTS:
+            delay = self.RETRY_BASE * 2 ** (delivery.attempt - 1)
+            delay = min(delay, self.RETRY_MAX) * random.uniform(0.5, 1)
+            MO_RETRIES.labels().inc()
+            self.scheduler.call_later(delay, self._put, delivery)
+        else:
+            for id, msg_dict in delivery.msgs:
+                logger.error('giving up sending message %s', msg_dict)
+                MO_GIVE_UPS.labels().inc()
+                self.dead_letters.add(id, msg_dict)
+                self._done(id)
 
     def enqueue(self, rx_sms):
+        rx_sms = dict(rx_sms)
+        if rx_sms.get('tstamp') is not None:
+            rx_sms['tstamp'] = str(rx_sms['tstamp'])
+        id = unique_id()
         with self.mutex:
-            if self.active:
-                self.queue.put(rx_sms)
-            else:
+            if not self.active:
                 raise HTTPClientManagerStoppingError()
+            self.spool.add(id, rx_sms)
+            if len(self._loaded) < self.MAX_IN_MEMORY:
+                self._load(id, rx_sms)
+            else:
+                self._n_spilled += 1
+
+    def replay_dead_letters(self):
+        """Move the dead letters back to the spool for a new round."""
+        n = 0
+        for id, rx_sms in self.dead_letters.scan():
+            self.enqueue(rx_sms)
+            self.dead_letters.ack(id)
+            n += 1
+        return n
+
+    def _load(self, id, rx_sms):
+        self._loaded.add(id)
+        url = rx_sms['url']
+        if not rx_sms.get('batch'):
+            delivery = Delivery(url)
+            delivery.add(id, rx_sms)
+            self._put(delivery)
+            return
+
+        max_size, max_linger = rx_sms['batch']
+        delivery = self._batches.get(url)
+        if delivery is None:
+            delivery = self._batches[url] = Delivery(url, batch=True)
+            self.scheduler.call_later(max_linger, self._flush_batch,
+                                      delivery)
+        delivery.add(id, rx_sms)
+        if len(delivery) >= max_size:
+            del self._batches[url]
+            self._put(delivery)
+
+    def _flush_batch(self, delivery):
+        with self.mutex:
+            if self._batches.get(delivery.url) is delivery:
+                del self._batches[delivery.url]
+                self._put(delivery)
+
+    def _done(self, id):
+        self.spool.ack(id)
+        with self.mutex:
+            self._loaded.discard(id)
+            if (self._n_spilled and self._refiller is None and
+                len(self._loaded) < self.MAX_IN_MEMORY / 2):
+                # the spool is scanned on disk: not on a forwarding thread
+                self._refiller = Thread(name='HttpClient refill',
+                                        target=self._refill)
+                self._refiller.daemon = True
+                self._refiller.start()
+
+    def _refill(self):
+        try:
+            for id, rx_sms in self.spool.scan(exclude=self._loaded):
+                with self.mutex:
+                    if (not self.active or
+                        len(self._loaded) >= self.MAX_IN_MEMORY):
+                        break
+                    if id in self._loaded:
+                        continue
+                    self._load(id, rx_sms)
+                    self._n_spilled -= 1
+        except Exception:
+            logger.error('error while loading the spooled sms', exc_info=True)
+        finally:
+            with self.mutex:
+                self._refiller = None
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return value
 
 
 http_client_manager = HTTPClientManager()
-
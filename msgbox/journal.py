@@ -0,0 +1,241 @@
+import errno
+import json
+import os
+import shutil
+from threading import Thread, Condition, Lock
+
+from msgbox import logger
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class Journal(object):
+    """Append-only file of json records with group-commit fsync.
+
+    Records are written by the caller thread; a committer thread fsyncs
+    everything written so far in one go and then invokes the commit
+    callbacks of those records.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fout = None
+        self.thread = None
+        self.active = False
+        self.cond = Condition()
+        self.fsync_lock = Lock()
+        self._callbacks = []
+        self._dirty = False
+
+    def open(self):
+        _makedirs(os.path.dirname(self.path))
+        self.fout = open(self.path, 'a')
+        self.active = True
+        self.thread = Thread(name='Journal %s' % os.path.basename(self.path),
+                             target=self._work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        with self.cond:
+            self.active = False
+            self.cond.notify()
+        self.thread.join()
+        self.fout.close()
+
+    def replay(self):
+        """Yield the records found on disk. A truncated tail is skipped."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as fin:
+            for line in fin:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warn('journal %s: skipping corrupted record',
+                                self.path)
+
+    def append(self, record, callback=None):
+        line = json.dumps(record, separators=(',', ':'))
+        with self.cond:
+            if not self.active:
+                raise IOError('journal %s is closed' % self.path)
+            self.fout.write(line + '\n')
+            self._dirty = True
+            if callback is not None:
+                self._callbacks.append(callback)
+            self.cond.notify()
+
+    def rewrite(self, records):
+        """Atomically replace the journal content with `records`."""
+        tmp_file = self.path + '.tmp'
+        with self.cond:
+            with self.fsync_lock:
+                self._commit()
+                with open(tmp_file, 'w') as fout:
+                    for record in records:
+                        line = json.dumps(record, separators=(',', ':'))
+                        fout.write(line + '\n')
+                    fout.flush()
+                    os.fsync(fout.fileno())
+                os.rename(tmp_file, self.path)
+                self.fout.close()
+                self.fout = open(self.path, 'a')
+
+    def compact(self, keep):
+        """Atomically drop the records for which `keep(record)` is false.
+
+        Appends go on while the records on disk are filtered: they are
+        held only while the records appended meanwhile are copied over.
+        """
+        tmp_file = self.path + '.tmp'
+        with self.cond:
+            self.fout.flush()
+            end = os.fstat(self.fout.fileno()).st_size
+        with open(self.path) as fin, open(tmp_file, 'w') as fout:
+            pos = 0
+            while pos < end:
+                line = fin.readline()
+                if not line:
+                    break
+                pos += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warn('journal %s: skipping corrupted record',
+                                self.path)
+                    continue
+                if keep(record):
+                    fout.write(line)
+            with self.cond:
+                with self.fsync_lock:
+                    self.fout.flush()
+                    fin.seek(end)
+                    shutil.copyfileobj(fin, fout)
+                    fout.flush()
+                    os.fsync(fout.fileno())
+                    os.rename(tmp_file, self.path)
+                    self.fout.close()
+                    self.fout = open(self.path, 'a')
+
+    def _commit(self):
+        self.fout.flush()
+        os.fsync(self.fout.fileno())
+        self._dirty = False
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while self.active and not self._dirty:
+                    self.cond.wait()
+                if not self._dirty:
+                    break
+                callbacks, self._callbacks = self._callbacks, []
+                self.fout.flush()
+                self._dirty = False
+                # records written from now on belong to the next group
+                self.fsync_lock.acquire()
+            try:
+                os.fsync(self.fout.fileno())
+            except Exception:
+                logger.error('journal %s: fsync failed', self.path,
+                             exc_info=True)
+            finally:
+                self.fsync_lock.release()
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    logger.error('journal %s: error in commit callback',
+                                 self.path, exc_info=True)
+
+
+class Spool(object):
+    """Durable set of pending items backed by a Journal.
+
+    Only the ids of pending items are kept in memory: compaction streams
+    the still pending items from the old journal into the new one, on a
+    thread of its own.
+    """
+
+    COMPACT_MIN_ACKS = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.journal = Journal(path)
+        self.mutex = Lock()
+        self.pending_ids = set()
+        self.n_acks = 0
+        self.compactor = None
+
+    def __len__(self):
+        return len(self.pending_ids)
+
+    def open(self):
+        for record in self.journal.replay():
+            if 'ack' in record:
+                self.pending_ids.discard(record['ack'])
+                self.n_acks += 1
+            else:
+                self.pending_ids.add(record['id'])
+        self.journal.open()
+        logger.info('spool %s: %d pending item(s)', self.path,
+                                                   len(self.pending_ids))
+
+    def close(self):
+        compactor = self.compactor
+        if compactor is not None:
+            compactor.join()
+        self.journal.close()
+
+    def add(self, id, data, callback=None):
+        with self.mutex:
+            self.pending_ids.add(id)
+        self.journal.append(dict(id=id, data=data), callback)
+
+    def ack(self, id):
+        with self.mutex:
+            if id not in self.pending_ids:
+                return
+            self.pending_ids.remove(id)
+            self.journal.append(dict(ack=id))
+            self.n_acks += 1
+            if (self.compactor is None and
+                self.n_acks >= self.COMPACT_MIN_ACKS and
+                self.n_acks > len(self.pending_ids)):
+                self.compactor = Thread(name='Compactor %s' %
+                                             os.path.basename(self.path),
+                                        target=self._compact)
+                self.compactor.daemon = True
+                self.compactor.start()
+
+    def scan(self, exclude=()):
+        """Yield (id, data) of pending items in arrival order."""
+        for record in self.journal.replay():
+            id = record.get('id')
+            if id in self.pending_ids and id not in exclude:
+                yield id, record['data']
+
+    def _compact(self):
+        # items are added to pending_ids before being journaled: a record
+        # whose id is not pending (anymore) has been acked
+        pending_ids = self.pending_ids
+        with self.mutex:
+            n_acks = self.n_acks
+        try:
+            self.journal.compact(lambda r: r.get('id') in pending_ids)
+        except Exception:
+            logger.error('spool %s: compaction failed', self.path,
+                         exc_info=True)
+        else:
+            logger.info('spool %s: compacted (%d pending item(s))',
+                        self.path, len(pending_ids))
+        with self.mutex:
+            self.n_acks -= n_acks
+            self.compactor = None
@@ -6,9 +6,14 @@ import sys
 import tornado.ioloop
 
 from msgbox import logger
-from msgbox.http import http_server_manager, http_client_manager
+from msgbox.devices import device_cache
+from msgbox.metrics import registry
+from msgbox.http import (http_server_manager, http_client_manager,
+                         HTTPClientManager)
 from msgbox.serial import SerialPortManager
-from msgbox.sim import sim_manager
+from msgbox.simulator import ModemFarm, SimulatedWebhookHandler
+from msgbox.worker import ModemWorker, concat_pool, held_sms
+from msgbox.sim import sim_manager, TxSmsReq
 
 
 parser = argparse.ArgumentParser()
@@ -16,14 +21,78 @@ parser.add_argument("--debug",    help="log at debug level",
                                   action='store_true')
 parser.add_argument("--usb-only", help="manage usb modems only",
                                   action='store_true')
+parser.add_argument("--port",     help="port of the sms api (default: 8080)",
+                                  type=int, default=http_server_manager.port)
+parser.add_argument("--admin-port", help="port of the admin and debug api, "
+                                         "on localhost only (default: 8081)",
+                                    type=int,
+                                    default=http_server_manager.admin_port)
+parser.add_argument("--trace",    help="time the stages of sms tx requests, "
+                                  "see /debug/traces",
+                                  action='store_true')
+parser.add_argument("--mailbox-size", help="max sms tx requests queued per "
+                                           "modem",
+                                      type=int,
+                                      default=ModemWorker.MAILBOX_SIZE)
+parser.add_argument("--mo-forwarder", help="forward received sms using "
+                                           "threads or the tornado ioloop",
+                                      choices=HTTPClientManager.MODES,
+                                      default='thread')
+parser.add_argument("--mo-concurrency", help="max concurrent forwarding "
+                                             "requests",
+                                        type=int,
+                                        default=HTTPClientManager.N_WORKERS)
+parser.add_argument("--simulate", help="run N simulated modems instead of "
+                                       "the serial ports",
+                                  type=int, metavar='N')
+parser.add_argument("--sim-send-latency", help="simulated secs per sent sms",
+                                          type=float, default=1.0)
+parser.add_argument("--sim-failure-rate", help="ratio of failing sends",
+                                          type=float, default=0.)
+parser.add_argument("--sim-inbound-rate", help="received sms/sec per "
+                                               "simulated modem",
+                                          type=float, default=0.)
+parser.add_argument("--sim-multipart-ratio", help="ratio of multipart "
+                                                  "received sms",
+                                             type=float, default=0.2)
+parser.add_argument("--sim-dropout-rate", help="network drop-outs/hour per "
+                                               "simulated modem",
+                                          type=float, default=0.)
+parser.add_argument("--sim-dropout-duration", help="secs of a drop-out",
+                                              type=float, default=30)
+parser.add_argument("--sim-webhook", help="url received sms are forwarded "
+                                          "to (default: a local sink)")
 
 
 def finalize_shutdown():
+    concat_pool.stop()
+    held_sms.close()
     http_client_manager.stop()
     ioloop = tornado.ioloop.IOLoop.instance()
     ioloop.add_callback(ioloop.stop)
 
 
+def make_simulated_serial_manager(args):
+    webhook = args.sim_webhook
+    if webhook is None:
+        http_server_manager.add_handlers([
+            (r"/simulated_webhook", SimulatedWebhookHandler)])
+        webhook = 'http://127.0.0.1:%d/simulated_webhook' % \
+                  http_server_manager.port
+    farm = ModemFarm(args.simulate,
+                     send_latency=args.sim_send_latency,
+                     failure_rate=args.sim_failure_rate,
+                     inbound_rate=args.sim_inbound_rate,
+                     multipart_ratio=args.sim_multipart_ratio,
+                     dropout_rate=args.sim_dropout_rate,
+                     dropout_duration=args.sim_dropout_duration,
+                     webhook=webhook)
+    sim_manager.new_sim_defaults = farm.sim_defaults
+    logger.info('simulating %d modem(s)', args.simulate)
+    return SerialPortManager(usb_only=False, comports=farm.comports,
+                             modem_factory=farm.modem_factory, hotplug=False)
+
+
 def main():
     args = parser.parse_args()
 
@@ -35,9 +104,24 @@ def main():
                                '%(message)s')
 
 
-    serial_manager = SerialPortManager(args.usb_only)
-
+    http_server_manager.port = args.port
+    http_server_manager.admin_port = args.admin_port
+    ModemWorker.MAILBOX_SIZE = args.mailbox_size
+    TxSmsReq.TRACING = args.trace
+    if args.simulate:
+        serial_manager = make_simulated_serial_manager(args)
+    else:
+        serial_manager = SerialPortManager(args.usb_only)
+    http_client_manager.configure(mode=args.mo_forwarder,
+                                  concurrency=args.mo_concurrency)
+    for component in (sim_manager, serial_manager, concat_pool,
+                      http_client_manager):
+        registry.add_collector(component.metrics)
+
+    device_cache.load()
     http_client_manager.start()
+    concat_pool.start()
+    held_sms.open()
     sim_manager.start()
     serial_manager.start()
     http_server_manager.start()
@@ -0,0 +1,180 @@
+import bisect
+import itertools
+from collections import OrderedDict
+from threading import Lock
+
+
+# secs
+DEFAULT_BUCKETS = (.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _count_value(count):
+    # reads an itertools.count without advancing it
+    return count.__reduce__()[1][0]
+
+
+class Counter(object):
+    """Monotonic counter.
+
+    `inc` takes no lock: advancing an itertools.count is atomic under
+    the GIL.
+    """
+
+    def __init__(self):
+        self._count = itertools.count()
+
+    def inc(self):
+        next(self._count)
+
+    @property
+    def value(self):
+        return _count_value(self._count)
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Histogram(object):
+    """Distribution of observed values over fixed buckets.
+
+    Bucket counts take no lock; only the running sum does.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = list(buckets)
+        self._counts = [itertools.count() for _ in xrange(len(buckets) + 1)]
+        self._sum_lock = Lock()
+        self._sum = 0.
+
+    def observe(self, value):
+        next(self._counts[bisect.bisect_left(self.bounds, value)])
+        with self._sum_lock:
+            self._sum += value
+
+    def samples(self, name, labels):
+        cumulative = 0
+        bounds = [repr(float(b)) for b in self.bounds] + ['+Inf']
+        for bound, count in zip(bounds, self._counts):
+            cumulative += _count_value(count)
+            yield (name + '_bucket', dict(labels, le=bound), cumulative)
+        yield name + '_sum', labels, self._sum
+        yield name + '_count', labels, cumulative
+
+
+class Metric(object):
+    """Family of metrics of the same kind, one per set of label values."""
+
+    def __init__(self, name, type, help, label_names, factory):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.factory = factory
+        self.children = {}
+        if not self.label_names:
+            # reported as zero from the start
+            self.labels()
+
+    def labels(self, *values):
+        assert len(values) == len(self.label_names)
+        child = self.children.get(values)
+        if child is None:
+            # dict.setdefault is atomic: racing threads get the same child
+            child = self.children.setdefault(values, self.factory())
+        return child
+
+    def samples(self):
+        for values, child in self.children.items():
+            labels = dict(zip(self.label_names, values))
+            for sample in child.samples(self.name, labels):
+                yield sample
+
+
+class Registry(object):
+    """Metrics exposed in the prometheus text format.
+
+    Metrics updated on the hot path are created with `counter` and
+    `histogram`. The others are read at scrape time from collectors:
+    funs returning a list of (name, type, help, [(labels, value), ...]).
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help, labels=()):
+        metric = Metric(name, 'counter', help, labels, Counter)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Metric(name, 'histogram', help, labels,
+                        lambda: Histogram(buckets))
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        families = OrderedDict()
+        for metric in self.metrics:
+            families[metric.name] = (metric.type, metric.help,
+                                     list(metric.samples()))
+        for collector in self.collectors:
+            for name, type, help, samples in collector():
+                # the same gauge may be reported by several collectors
+                _, _, all_samples = families.setdefault(name,
+                                                        (type, help, []))
+                all_samples.extend((name, labels, value)
+                                   for labels, value in samples)
+        lines = []
+        for name, (type, help, samples) in families.iteritems():
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, type))
+            for sample_name, labels, value in samples:
+                lines.append('%s%s %s' % (sample_name, _format_labels(labels),
+                                          _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v))
+                             for k, v in sorted(labels.iteritems()))
+
+
+def _escape(value):
+    value = value if isinstance(value, basestring) else str(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    return (value.replace('\\', r'\\').replace('\n', r'\n')
+                 .replace('"', r'\"'))
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def actor_metrics(actors):
+    """Collected metrics of the mailboxes of `actors`."""
+    depth, oldest_age = [], []
+    for actor in actors:
+        stats = actor.mailbox.stats
+        labels = dict(actor=actor.thread.name)
+        depth.append((labels, stats['depth']))
+        oldest_age.append((labels, stats['oldest_age']))
+    return [
+        ('msgbox_mailbox_depth', 'gauge',
+         'msgs waiting in the actor mailbox', depth),
+        ('msgbox_mailbox_oldest_age_seconds', 'gauge',
+         'age of the oldest msg in the actor mailbox', oldest_age),
+    ]
+
+
+registry = Registry()
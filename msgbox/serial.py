@@ -1,13 +1,20 @@
 from __future__ import absolute_import
 import os
+import socket
+import struct
 import sys
 from collections import namedtuple
+from threading import Thread
 
+from gsmmodem.modem import GsmModem
 from serial.tools.list_ports import comports
 
 from msgbox import logger
-from msgbox.actor import Actor, StopActor, Timeout
-from msgbox.worker import ModemWorker
+from msgbox.actor import (Actor, Message, StopActor, Timeout,
+                          RejectedMsgException)
+from msgbox.devices import device_cache, device_key
+from msgbox.metrics import actor_metrics
+from msgbox.worker import ModemWorker, StopWorker
 from msgbox.sim import ShutdownNotification
 
 
@@ -17,25 +24,135 @@ plat = sys.platform.lower()
 SerialPortInfo = namedtuple('SerialPortInfo', ['dev', 'desc', 'hw'])
 
 
+# linux/netlink.h
+NETLINK_KOBJECT_UEVENT = 15
+# events re-broadcast by udev once its rules (permissions included) ran
+UDEV_UEVENT_GROUP = 2
+# libudev-monitor.c: "libudev\0", magic, header_size, properties_off,
+# properties_len, ... (magic in network order, the rest in host order)
+UDEV_HEADER = struct.Struct('=8sIIII')
+UDEV_MAGIC = 0xfeedcafe
+
+
+class SerialPortsChanged(Message):
+    """A tty device has been added, changed or removed."""
+
+    def __init__(self, action, devname):
+        self.action = action
+        self.devname = devname
+
+
+class UeventMonitor(object):
+    """Listen to the hotplug events of tty devices (linux only).
+
+    Events are taken from udev rather than from the kernel: the kernel
+    event comes before udev has set the permissions of the device node,
+    which could not be opened yet. Without a running udev no event shows
+    up and only the periodic port scans are left.
+
+    `callback(action, devname)` runs on the monitor thread, which sleeps
+    in recv() between events.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.sock = None
+        self.thread = None
+
+    def start(self):
+        """Return False if hotplug events are not available."""
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                 NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, UDEV_UEVENT_GROUP))
+        except (AttributeError, socket.error), e:
+            logger.info('hotplug events not available: %s', e)
+            return False
+        self.sock = sock
+        self.thread = Thread(name='UeventMonitor', target=self._work)
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def _work(self):
+        while True:
+            try:
+                data = self.sock.recv(16384)
+            except socket.error:
+                logger.error('error while reading hotplug events',
+                             exc_info=True)
+                return
+            env = self._parse(data)
+            if env is None:
+                continue
+            if (env.get('SUBSYSTEM') == 'tty' and
+                env.get('ACTION') in ('add', 'change', 'remove')):
+                self.callback(env['ACTION'], env.get('DEVNAME'))
+
+    @staticmethod
+    def _parse(data):
+        """Return the KEY=value properties of an udev event as a dict,
+        None if `data` is not an udev event."""
+        if len(data) < UDEV_HEADER.size:
+            return None
+        prefix, magic, _, offset, length = UDEV_HEADER.unpack_from(data)
+        if (prefix != 'libudev\0' or
+            socket.ntohl(magic) != UDEV_MAGIC):
+            return None
+        fields = data[offset:offset + length].split('\0')
+        return dict(field.split('=', 1) for field in fields if '=' in field)
+
+
 class SerialPortManager(Actor):
 
-    def __init__(self, usb_only):
+    # secs between port scans when hotplug events are not available
+    POLL_INTERVAL = 5
+    # with hotplug events, scans only act as a safety net
+    HOTPLUG_POLL_INTERVAL = 60
+
+    def __init__(self, usb_only, comports=comports, modem_factory=GsmModem,
+                 hotplug=True):
         self.usb_only = usb_only
+        self.comports = comports
+        self.modem_factory = modem_factory
         if usb_only and plat[:5] != 'linux':
             logger.error('--usb-only supported only on linux (ignored)')
             self.usb_only = False
+        self.hotplug = hotplug and plat[:5] == 'linux'
+        self.uevent_monitor = None
         self.dev2worker = {}  # {'/dev/ttyS0': ModemHandler(), ...
+        self.stopping = set()  # devs of the workers told to stop
+        self.skipped = set()   # devs of the known non-modems
+        self.replugged = set() # devs added or changed since last scan
         super(SerialPortManager, self).__init__('SerialPortManager')
 
+    def metrics(self):
+        workers = self.dev2worker.values()
+        states, signals = [], []
+        for worker in workers:
+            labels = dict(dev=worker.dev, imsi=worker.imsi or '')
+            states.append((dict(labels, state=worker.state), 1))
+            # last known value: a scrape never triggers a network check
+            signal = worker.network_status.value.signal
+            if signal is not None:
+                signals.append((labels, signal))
+        return actor_metrics([self] + workers) + [
+            ('msgbox_modem_state', 'gauge',
+             'current state of the modem worker', states),
+            ('msgbox_modem_signal', 'gauge',
+             'signal strength reported by the modem (0-31)', signals),
+        ]
+
     def remove_worker(self, worker):
         self.dev2worker.pop(worker.dev, None)
+        self.stopping.discard(worker.dev)
         # TODO remove the following sanity check
         for w in self.dev2worker.values():
             assert w is not worker
 
     def detect_serial_ports(self):
         serial_devices = set()
-        for d in comports():
+        for d in self.comports():
             dev, desc, hw = d
             if hw == 'n/a':
                 continue
@@ -49,23 +166,62 @@ class SerialPortManager(Actor):
 
             if dev not in self.dev2worker:
                 spi = SerialPortInfo(desc=desc, dev=dev, hw=hw)
-                mw = ModemWorker(dev=dev, serial_info=spi, serial_manager=self)
+                key = device_key(spi)
+                # a modem booting slowly may have failed its probes
+                if (dev in self.replugged and
+                    device_cache.forget_non_modems(key)):
+                    logger.info('device %s replugged: probed again', dev)
+                if device_cache.is_non_modem(key):
+                    if dev not in self.skipped:
+                        logger.info('skipping device %s: not a modem', dev)
+                        self.skipped.add(dev)
+                    continue
+                self.skipped.discard(dev)
+                mw = ModemWorker(dev=dev, serial_info=spi, serial_manager=self,
+                                 modem_factory=self.modem_factory)
                 logger.info('starting worker for device %s', dev)
                 mw.start()
                 self.dev2worker[dev] = mw
 
-        for dev in self.dev2worker.keys():
-            if dev not in serial_devices:
-                logger.info('active worker on missing device %s', dev)
+        self.skipped &= serial_devices
+        self.replugged.clear()
+        for dev, worker in self.dev2worker.items():
+            if dev not in serial_devices and dev not in self.stopping:
+                # a new worker is started only once this one is gone
+                logger.info('device %s vanished: stopping its worker', dev)
+                self.stopping.add(dev)
+                try:
+                    worker.send(StopActor())
+                except RejectedMsgException:
+                    # shutting down already
+                    pass
+
+    def _on_uevent(self, action, devname):
+        logger.debug('hotplug event: %s %s', action, devname)
+        try:
+            self.send(SerialPortsChanged(action, devname))
+        except RejectedMsgException:
+            pass
 
     def run(self):
+        poll_interval = self.POLL_INTERVAL
+        if self.hotplug:
+            self.uevent_monitor = UeventMonitor(self._on_uevent)
+            if self.uevent_monitor.start():
+                poll_interval = self.HOTPLUG_POLL_INTERVAL
         while True:
             self.detect_serial_ports()
-            msg = self.receive(timeout=5)
-            if isinstance(msg, StopActor):
+            msg = self.receive(timeout=poll_interval)
+            if isinstance(msg, SerialPortsChanged):
+                # a single scan covers a burst of events
+                while not isinstance(msg, Timeout):
+                    if msg.action in ('add', 'change'):
+                        self.replugged.add(msg.devname)
+                    msg = self.receive(typ=SerialPortsChanged, block=False)
+            elif isinstance(msg, StopActor):
                 for worker in self.dev2worker.itervalues():
                     logger.info('stopping worker for device %s', worker.dev)
-                    worker.send(StopActor())
+                    worker.send(StopWorker(exiting=True))
                 self.dev2worker = {}
                 break
             elif isinstance(msg, ShutdownNotification):
@@ -1,12 +1,21 @@
 import json
 import os
+import time
+from collections import defaultdict, deque
+from functools import partial
 
 from msgbox import logger
-from msgbox.actor import Actor, Message, StopActor, ChannelClosed
-from msgbox.util import status
+from msgbox.encoding import POLICIES
+from msgbox.actor import (Actor, Message, StopActor, ChannelClosed, Timeout,
+                          RejectedMsgException)
+from msgbox.journal import Journal, Spool
+from msgbox.metrics import actor_metrics
+from msgbox.util import status, monotonic, unique_id
 
 
 DUMP_FILE = os.path.expanduser('~/.msgboxrc')
+CONFIG_JOURNAL_FILE = os.path.expanduser('~/.msgbox/sim_config.journal')
+TX_SPOOL_FILE = os.path.expanduser('~/.msgbox/tx_sms.spool')
 
 
 class SimConfig(object):
@@ -17,6 +26,14 @@ class SimConfig(object):
         self.phone_number = None
         self.url = None
         self.active = True
+        # name of the pool of sims sharing the load of MT requests
+        self.pool = None
+        # transliteration of MT text (see msgbox.encoding.POLICIES)
+        self.encoding_policy = 'keep'
+        # batched webhook delivery (opt-in): up to batch_size sms are
+        # posted as a json array after lingering at most batch_linger secs
+        self.batch_size = None
+        self.batch_linger = 1.0
 
     @property
     def is_startable(self):
@@ -28,23 +45,50 @@ class SimConfig(object):
     def as_dict(self):
         return vars(self)
 
+    def copy(self):
+        return SimConfig.from_dict(dict(self.as_dict))
+
     @classmethod
     def from_dict(cls, d):
         config = cls(d.pop('imsi'))
         for k, v in d.items():
             setattr(config, k, v)
+        if config.encoding_policy not in POLICIES:
+            logger.error('imsi %s: unknown encoding_policy %r (using '
+                         '"keep")', config.imsi, config.encoding_policy)
+            config.encoding_policy = 'keep'
         return config
 
 
 class SimConfigDB(Actor):
+    """Sim configs, saved as a DUMP_FILE snapshot plus a journal.
+
+    Every change appends the whole changed config to the journal, which
+    is fsynced in the background: the caller never waits for the disk.
+    Every COMPACT_EVERY changes, at startup and at close, the journal is
+    folded into a new snapshot and truncated.
+    """
+
+    COMPACT_EVERY = 100
 
     def __init__(self):
         self.imsi2config = {}
         self.phone_number2config = {}
+        self.pool2configs = defaultdict(list)
+        self.journal = Journal(CONFIG_JOURNAL_FILE)
+        self.n_changes = 0
         self._load_dump()
+        self.journal.open()
+        if self.n_changes:
+            self._compact()
+
+    def close(self):
+        if self.n_changes:
+            self._compact()
+        self.journal.close()
 
     def update(self, imsi, desc=None, phone_number=None, url=None,
-               active=None):
+               active=None, pool=None):
         assert active in (None, False, True)
         config = self._pop(imsi)
 
@@ -52,18 +96,22 @@ class SimConfigDB(Actor):
         if phone_number is not None: config.phone_number = phone_number.strip()
         if url          is not None: config.url          = url.strip()
         if active       is not None: config.active       = bool(active)
+        if pool         is not None: config.pool         = pool.strip() or None
         self._insert(config)
-        self._save_dump()
+        self._log(config)
 
     def add(self, imsi):
         assert imsi not in self.imsi2config
         sim_config = SimConfig(imsi)
         self._insert(sim_config)
-        self._save_dump()
+        self._log(sim_config)
 
     def route(self, phone_number):
         return self.phone_number2config.get(phone_number)
 
+    def pool(self, name):
+        return self.pool2configs.get(name, [])
+
     def _load_dump(self):
         if os.path.exists(DUMP_FILE):
             with open(DUMP_FILE) as fin:
@@ -74,6 +122,15 @@ class SimConfigDB(Actor):
                 logger.info('loaded config for %d sim card(s)', len(data))
         else:
             logger.info('config %s not found', DUMP_FILE)
+        # changes made after the snapshot, oldest first
+        for d in self.journal.replay():
+            config = SimConfig.from_dict(d)
+            if config.imsi in self.imsi2config:
+                self._pop(config.imsi)
+            self._insert(config)
+            self.n_changes += 1
+        if self.n_changes:
+            logger.info('replayed %d sim config change(s)', self.n_changes)
 
     def _save_dump(self):
         tmp_file = DUMP_FILE + '.tmp'
@@ -82,19 +139,41 @@ class SimConfigDB(Actor):
             sorted_configs = sorted(configs, key=lambda c: c.imsi)
             data = list(c.as_dict for c in sorted_configs)
             json.dump(data, fout, indent=2, sort_keys=True)
+            fout.flush()
+            os.fsync(fout.fileno())
         os.rename(tmp_file, DUMP_FILE)
 
+    def _log(self, sim_config):
+        self.journal.append(sim_config.as_dict)
+        self.n_changes += 1
+        if self.n_changes >= self.COMPACT_EVERY:
+            self._compact()
+
+    def _compact(self):
+        # replaying the journal over the new snapshot is harmless: the
+        # journal is truncated only once the snapshot is on disk
+        self._save_dump()
+        self.journal.rewrite([])
+        self.n_changes = 0
+
     def _insert(self, sim_config):
         self.imsi2config[sim_config.imsi] = sim_config
         phone_number = sim_config.phone_number
         if phone_number:
             self.phone_number2config[phone_number] = sim_config
+        if sim_config.pool:
+            self.pool2configs[sim_config.pool].append(sim_config)
 
     def _pop(self, imsi):
         sim_config = self.imsi2config.pop(imsi)
         phone_number = sim_config.phone_number
         if phone_number:
             del self.phone_number2config[phone_number]
+        if sim_config.pool:
+            pool = self.pool2configs[sim_config.pool]
+            pool.remove(sim_config)
+            if not pool:
+                del self.pool2configs[sim_config.pool]
         return sim_config
 
     def __getitem__(self, imsi):
@@ -113,12 +192,34 @@ class WorkerMessage(Message):
         self.worker = worker
 
 
-class SimConfigChanged(Message): pass
+class SimConfigChanged(Message):
+
+    def __init__(self, config):
+        # a copy: the worker owns it, SimConfigDB keeps changing its own
+        self.config = config
+
+
+class UpdateSimConfig(Message):
+    """Change `changes` (SimConfigDB.update() kwargs) of sim `imsi`."""
+
+    def __init__(self, imsi, changes, callback):
+        self.imsi = imsi
+        self.changes = changes
+        self.callback = callback
+
+
 class ImsiRegister(WorkerMessage): pass
-class ImsiUnregister(WorkerMessage): pass
 class ShutdownNotification(WorkerMessage): pass
 
 
+class ImsiUnregister(WorkerMessage):
+
+    def __init__(self, worker):
+        # the worker may move on to a new imsi (sim swap) meanwhile
+        self.worker = worker
+        self.imsi = worker.imsi
+
+
 class ImsiRegistration(Message):
 
     def __init__(self, success, config):
@@ -134,17 +235,51 @@ class StopSimManager(StopActor):
 
 class TxSmsReq(Message):
 
-    def __init__(self, sender, recipient, text, imsi, key, callback=None):
+    FIELDS = ('sender', 'recipient', 'text', 'imsi', 'key', 'id', 'pool')
+    # record the stage timestamps, see `trace` (--trace)
+    TRACING = False
+
+    def __init__(self, sender, recipient, text, imsi, key, callback=None,
+                 id=None, pool=None):
         self.sender = sender
         self.recipient = recipient
         self.text = text
         self.imsi = imsi
         self.key = key
         self.callback = callback
+        self.id = id or unique_id()
+        self.pool = pool
+        self.marks = []  # [(stage, monotonic secs), ...]
+
+    def mark(self, stage):
+        """Record that the request reached `stage` now, if TRACING."""
+        if self.TRACING:
+            self.marks.append((stage, monotonic()))
+
+    @property
+    def trace(self):
+        """Time spent (ms) before reaching every stage."""
+        stages = []
+        prev = start = self.marks[0][1] if self.marks else None
+        for stage, tstamp in self.marks:
+            stages.append([stage, round((tstamp - prev) * 1000, 3)])
+            prev = tstamp
+        total = round((prev - start) * 1000, 3) if self.marks else 0.
+        return dict(id=self.id, total_ms=total, stages=stages)
+
+    @property
+    def as_dict(self):
+        return dict((f, getattr(self, f)) for f in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, d, callback=None):
+        return cls(callback=callback, **d)
 
     def __str__(self):
         if self.sender:
             field = 'sender "%s"' % self.sender
+        elif self.pool:
+            field = 'pool "%s"' % self.pool
         else:
             field = 'imsi "%s"' % self.imsi
         return "sms tx request for %s" % field
@@ -152,30 +287,93 @@ class TxSmsReq(Message):
 
 class SimManager(Actor):
 
+    # how long replayed sms tx requests wait for their modem to show up
+    REPLAY_GRACE = 120
+    # max sms tx requests waiting to be routed
+    MAILBOX_SIZE = 10000
+    # traces of the last answered sms tx requests kept for inspection
+    TRACES_KEPT = 1000
+
     def __init__(self):
         # the same modem may show up with different serials
         # (e.g. ttyACM0 and ttyACM1). imsi2worker allow to track the
         # ModemWorker that exclusively grabs the modem.
         self.imsi2worker = {}
         self.sim_config_db = None
+        # optional fun(imsi) -> dict of SimConfigDB.update() kwargs,
+        # applied to the sims seen for the first time
+        self.new_sim_defaults = None
+        self.tx_spool = Spool(TX_SPOOL_FILE)
+        self._replayed = []
+        self._replay_deadline = None
+        self.traces = deque(maxlen=self.TRACES_KEPT)
         self._shutting_down = False
         self._shutdown_callback = None
-        super(SimManager, self).__init__('SimManager')
+        super(SimManager, self).__init__('SimManager',
+                                         maxsize=self.MAILBOX_SIZE,
+                                         bounded_msgs=TxSmsReq)
+
+    def start(self):
+        self.tx_spool.open()
+        for id, d in self.tx_spool.scan():
+            tx_sms = TxSmsReq.from_dict(d)
+            tx_sms.callback = partial(self._replay_callback, tx_sms)
+            self._replayed.append(tx_sms)
+        if self._replayed:
+            logger.info('replaying %d spooled sms tx request(s)',
+                        len(self._replayed))
+            self._replay_deadline = time.time() + self.REPLAY_GRACE
+        super(SimManager, self).start()
+
+    def accept(self, tx_sms):
+        """Spool `tx_sms` and route it once it is durable on disk.
+
+        Raise RejectedMsgException if the mailbox is full.
+        """
+        tx_sms.mark('accept')
+        if self.is_full:
+            raise RejectedMsgException(tx_sms, self.expected_wait)
+        callback = tx_sms.callback
+        def acked_callback(response_dict):
+            if tx_sms.TRACING:
+                response_dict = dict(response_dict,
+                                     trace=self._trace(tx_sms))
+            self.tx_spool.ack(tx_sms.id)
+            if callback:
+                callback(response_dict)
+        tx_sms.callback = acked_callback
+        self.tx_spool.add(tx_sms.id, tx_sms.as_dict,
+                          callback=partial(self._send_accepted, tx_sms))
+
+    def _send_accepted(self, tx_sms):
+        try:
+            self.send(tx_sms)
+        except RejectedMsgException, e:
+            tx_sms.callback(status('ERROR', '%s: overloaded' % tx_sms,
+                                   retry_after=e.retry_after, code=503))
 
     def run(self):
         self.sim_config_db = SimConfigDB()
 
         while True:
-            msg = self.receive()
-            if isinstance(msg, ImsiRegister):
+            timeout = None
+            if self._replay_deadline is not None:
+                timeout = max(self._replay_deadline - time.time(), 0)
+            msg = self.receive(timeout=timeout)
+            if isinstance(msg, Timeout):
+                self._replay_deadline = None
+                self._route_replayed(force=True)
+            elif isinstance(msg, ImsiRegister):
                 self.register(msg.worker)
             elif isinstance(msg, ImsiUnregister):
-                self.unregister(msg.worker)
+                self.unregister(msg.worker, msg.imsi)
             elif isinstance(msg, StopSimManager):
                 self._shutting_down = True
                 self._shutdown_callback = msg.callback
             elif isinstance(msg, TxSmsReq):
                 self.route(msg)
+            elif isinstance(msg, UpdateSimConfig):
+                self.update_config(msg)
             else:
                 raise ValueError('unexpected msg type %s' % msg)
 
@@ -186,27 +384,57 @@ class SimManager(Actor):
     def stop(self, callback=None):
         self.send(StopSimManager(callback))
 
+    def metrics(self):
+        return actor_metrics([self]) + [
+            ('msgbox_mt_spooled', 'gauge',
+             'sms tx requests spooled and not answered yet',
+             [({}, len(self.tx_spool))]),
+        ]
+
     def shutdown(self):
         while True:
             msg = self.receive()
             if isinstance(msg, ChannelClosed):
+                self.tx_spool.close()
+                self.sim_config_db.close()
                 if self._shutdown_callback:
                     self._shutdown_callback()
                     break
             else:
                 logger.error('unexpected msg %s', msg)
 
-    def route(self, msg):
+    def _lookup(self, msg):
         sender = msg.sender
         imsi   = msg.imsi
         sim_config = None
 
+        if msg.pool:
+            return self._pick_from_pool(msg.pool)
         if sender:
             sim_config = self.sim_config_db.route(sender)
         if sim_config is None and imsi in self.sim_config_db:
             sim_config = self.sim_config_db[imsi]
+        return sim_config
+
+    def _pick_from_pool(self, pool):
+        """Return the config of the working sim expected to be free first."""
+        best_config, best_wait = None, None
+        for sim_config in self.sim_config_db.pool(pool):
+            worker = self.imsi2worker.get(sim_config.imsi)
+            if worker is None or worker.state != 'working':
+                continue
+            wait = worker.expected_wait
+            if best_config is None or wait < best_wait:
+                best_config, best_wait = sim_config, wait
+        return best_config
+
+    def route(self, msg):
+        sim_config = self._lookup(msg)
         if sim_config is None:
-            err_msg = '%s: sim not known' % msg
+            if msg.pool:
+                err_msg = '%s: no working sim in pool' % msg
+            else:
+                err_msg = '%s: sim not known' % msg
             if msg.callback:
                 msg.callback(status('ERROR', err_msg))
             return
@@ -214,7 +442,12 @@ class SimManager(Actor):
         worker = self.imsi2worker.get(sim_config.imsi)
         if worker:
             logger.info('%s: routing to dev %s', msg, worker.dev)
-            worker.send(msg)
+            msg.mark('route')
+            try:
+                worker.send(msg)
+            except RejectedMsgException, e:
+                msg.callback(status('ERROR', '%s: modem busy' % msg,
+                                    retry_after=e.retry_after))
         else:
             msg.callback(status('ERROR', '%s: sim not found' % msg))
 
@@ -234,12 +467,85 @@ class SimManager(Actor):
         if imsi not in self.sim_config_db:
             logger.info('new sim - imsi: %s', imsi)
             self.sim_config_db.add(imsi)
+            if self.new_sim_defaults is not None:
+                self.sim_config_db.update(imsi, **self.new_sim_defaults(imsi))
         config = self.sim_config_db[imsi]
 
-        worker.send(ImsiRegistration(success, config))
+        worker.send(ImsiRegistration(success, config.copy()))
+        if success:
+            self._route_replayed()
 
-    def unregister(self, worker):
-        del self.imsi2worker[worker.imsi]
+    def update_config(self, msg):
+        imsi = msg.imsi
+        db = self.sim_config_db
+        if imsi not in db:
+            msg.callback(status('ERROR', 'imsi %s: sim not known' % imsi))
+            return
+        for field in ('phone_number', 'url'):
+            value = msg.changes.get(field)
+            if value is not None and not value.strip():
+                err_msg = 'imsi %s: %s can\'t be blank' % (imsi, field)
+                msg.callback(status('ERROR', err_msg, code=400))
+                return
+        phone_number = msg.changes.get('phone_number')
+        if phone_number:
+            other = db.route(phone_number.strip())
+            if other is not None and other.imsi != imsi:
+                err_msg = 'imsi %s: phone number %s already used by imsi %s'
+                msg.callback(status('ERROR', err_msg % (imsi, phone_number,
+                                                        other.imsi)))
+                return
+        db.update(imsi, **msg.changes)
+        config = db[imsi]
+        logger.info('imsi %s: config updated %s', imsi, msg.changes)
+
+        applied = False
+        worker = self.imsi2worker.get(imsi)
+        if worker is not None:
+            try:
+                worker.send(SimConfigChanged(config.copy()))
+                applied = True
+            except RejectedMsgException:
+                # shutting down: the new config is used at next startup
+                pass
+        msg.callback(status('OK', 'imsi %s: config updated' % imsi,
+                            config=dict(config.as_dict), applied=applied))
+
+    def unregister(self, worker, imsi):
+        if self.imsi2worker.get(imsi) is worker:
+            del self.imsi2worker[imsi]
+
+    def _route_replayed(self, force=False):
+        """Route the replayed requests whose modem is available.
+
+        With `force` all of them are routed (or failed) anyway.
+        """
+        waiting = []
+        for tx_sms in self._replayed:
+            sim_config = self._lookup(tx_sms)
+            if (force or (sim_config is None and not tx_sms.pool) or
+                (sim_config is not None and
+                 sim_config.imsi in self.imsi2worker)):
+                self.route(tx_sms)
+            else:
+                waiting.append(tx_sms)
+        self._replayed = waiting
+        if not waiting:
+            self._replay_deadline = None
+
+    def _trace(self, tx_sms):
+        tx_sms.mark('callback')
+        trace = tx_sms.trace
+        self.traces.append(trace)
+        return trace
+
+    def _replay_callback(self, tx_sms, response_dict):
+        if tx_sms.TRACING:
+            self._trace(tx_sms)
+        self.tx_spool.ack(tx_sms.id)
+        log_method = logger.warn if response_dict['status'] == 'ERROR' else \
+                     logger.info
+        log_method('replayed %s', response_dict['desc'])
 
 
 sim_manager = SimManager()
@@ -0,0 +1,198 @@
+import random
+import time
+from datetime import datetime
+from threading import Condition, Thread
+
+from gsmmodem.modem import ReceivedSms, Sms, TimeoutException
+from gsmmodem.pdu import Concatenation
+from tornado.web import RequestHandler
+
+from msgbox import logger
+
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+
+class SimulatedModemError(Exception): pass
+
+
+class SimulatedModem(object):
+    """In-process stand-in for gsmmodem.modem.GsmModem.
+
+    Implements the subset of the GsmModem api used by ModemWorker.
+    """
+
+    def __init__(self, farm, index, smsReceivedCallbackFunc=None):
+        self.farm = farm
+        self.index = index
+        self.smsReceivedCallback = smsReceivedCallbackFunc
+        self.imsi = '00101%010d' % index
+        self.imei = '35000000%07d' % index
+        self.manufacturer = 'msgbox'
+        self.model = 'simulated'
+        self.revision = '1.0'
+        self.networkName = 'SIMNET'
+        self.smsc = '+390000000000'
+        self.cond = Condition()
+        self.stored = []
+        # +CNMI mt: notify new sms or keep them stored
+        self.notify = True
+        self.active = False
+        self.thread = None
+        self._down_until = 0
+        self._reference = 0
+
+    @property
+    def is_down(self):
+        return time.time() < self._down_until
+
+    @property
+    def signalStrength(self):
+        return 0 if self.is_down else 20
+
+    def connect(self):
+        self.active = True
+        self.thread = Thread(name='SimulatedModem %d' % self.index,
+                             target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        with self.cond:
+            self.active = False
+            self.cond.notify()
+
+    def write(self, data, *args, **kwargs):
+        if data.startswith('AT+CNMI='):
+            self.notify = data.split('=')[1].split(',')[1] != '0'
+        return ['OK']
+
+    def waitForNetworkCoverage(self, timeout=None):
+        if self.is_down:
+            left = self._down_until - time.time()
+            if timeout is not None and timeout < left:
+                time.sleep(timeout)
+                raise TimeoutException()
+            time.sleep(left)
+        return self.signalStrength
+
+    def sendSms(self, destination, text, *args, **kwargs):
+        if self.is_down:
+            raise TimeoutException()
+        latency = self.farm.send_latency
+        time.sleep(random.uniform(0.5, 1.5) * latency)
+        if random.random() < self.farm.failure_rate:
+            raise SimulatedModemError('simulated send failure')
+
+    def listStoredSms(self, status=Sms.STATUS_ALL, memory=None,
+                      delete=False):
+        with self.cond:
+            messages = [sms for sms in self.stored
+                            if status == Sms.STATUS_ALL or
+                               sms.status == status]
+            if delete:
+                self.stored = [sms for sms in self.stored
+                                   if sms not in messages]
+        return messages
+
+    def _run(self):
+        farm = self.farm
+        next_rx = self._next_event(farm.inbound_rate)
+        next_drop = self._next_event(farm.dropout_rate / 3600.)
+        while True:
+            with self.cond:
+                if not self.active:
+                    return
+                left = min(next_rx, next_drop) - time.time()
+                if left > 0:
+                    self.cond.wait(left)
+                    continue
+            now = time.time()
+            if now >= next_drop:
+                logger.info('simulated network drop-out on modem %d',
+                            self.index)
+                self._down_until = now + farm.dropout_duration
+                next_drop = self._next_event(farm.dropout_rate / 3600.)
+            if now >= next_rx:
+                for sms in self._random_sms():
+                    self._deliver(sms)
+                next_rx = self._next_event(farm.inbound_rate)
+
+    def _next_event(self, rate):
+        if rate <= 0:
+            return float('inf')
+        return time.time() + random.expovariate(rate)
+
+    def _random_sms(self):
+        sender = '+39333%07d' % random.randint(0, 9999999)
+        multipart = random.random() < self.farm.multipart_ratio
+        n_parts = random.randint(2, 4) if multipart else 1
+        self._reference = (self._reference + 1) % 256
+        messages = []
+        for i in range(1, n_parts + 1):
+            text = ' '.join(random.choice(WORDS) for _ in range(20))
+            sms = ReceivedSms(self, Sms.STATUS_RECEIVED_UNREAD, sender,
+                              datetime.now(), text[:153], self.smsc)
+            sms.udh = None
+            if multipart:
+                concat = Concatenation()
+                concat.reference = self._reference
+                concat.parts = n_parts
+                concat.number = i
+                sms.udh = [concat]
+            messages.append(sms)
+        # parts may reach the modem in any order
+        random.shuffle(messages)
+        return messages
+
+    def _deliver(self, sms):
+        if self.smsReceivedCallback is not None and self.notify:
+            self.smsReceivedCallback(sms)
+        else:
+            with self.cond:
+                self.stored.append(sms)
+
+
+class ModemFarm(object):
+    """A set of simulated modems exposed as fake serial ports."""
+
+    def __init__(self, n, send_latency=1.0, failure_rate=0.,
+                 inbound_rate=0., multipart_ratio=0.2, dropout_rate=0.,
+                 dropout_duration=30, webhook=None):
+        self.n = n
+        self.send_latency = send_latency
+        self.failure_rate = failure_rate
+        self.inbound_rate = inbound_rate          # sms/sec per modem
+        self.multipart_ratio = multipart_ratio
+        self.dropout_rate = dropout_rate          # drop-outs/hour per modem
+        self.dropout_duration = dropout_duration  # secs
+        self.webhook = webhook
+
+    def comports(self):
+        """Replacement of serial.tools.list_ports.comports."""
+        return [('/sim/modem%d' % i, 'simulated modem',
+                 'SIM VID:PID=0000:0000 SER=SIM%04d' % i)
+                for i in range(self.n)]
+
+    def modem_factory(self, dev, baudrate, smsReceivedCallbackFunc=None):
+        index = int(dev[len('/sim/modem'):])
+        return SimulatedModem(self, index, smsReceivedCallbackFunc)
+
+    def sim_defaults(self, imsi):
+        """Config of the sims found in simulated modems."""
+        index = int(imsi[5:])
+        return dict(desc='simulated modem %d' % index,
+                    phone_number='+39000%07d' % index,
+                    url=self.webhook,
+                    pool='simulated')
+
+
+class SimulatedWebhookHandler(RequestHandler):
+    """Sink for the sms forwarded from the simulated modems."""
+
+    n_received = 0
+
+    def post(self):
+        SimulatedWebhookHandler.n_received += 1
+        self.write('OK')
@@ -1,31 +1,116 @@
-import functools
+import ctypes
+import ctypes.util
+import heapq
+import itertools
+import os
+import sys
 import time
+from threading import Condition, Lock, Thread
 
+from msgbox import logger
 
-def status(status, desc):
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _clock_gettime():
+    libname = ctypes.util.find_library('rt') or ctypes.util.find_library('c')
+    try:
+        fun = ctypes.CDLL(libname, use_errno=True).clock_gettime
+    except (OSError, AttributeError, TypeError):
+        return None
+    fun.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    return fun
+
+
+CLOCK_MONOTONIC = 1  # linux
+
+
+def _monotonic():
+    ts = _timespec()
+    if _clock_gettime_fun(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, 'clock_gettime failed')
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+# secs from an arbitrary point, never going backwards: use it to measure
+# intervals. Falls back to the wall clock outside linux.
+_clock_gettime_fun = None
+if sys.platform.startswith('linux'):
+    _clock_gettime_fun = _clock_gettime()
+if _clock_gettime_fun is not None:
+    monotonic = _monotonic
+else:
+    monotonic = time.time
+
+
+# ids unique across restarts: pid and start time, then a counter.
+# Much cheaper than uuid4, which reads os.urandom on every call.
+_id_prefix = '%x%x' % (os.getpid(), int(time.time()))
+_id_counter = itertools.count()
+
+
+def unique_id():
+    return '%s-%x' % (_id_prefix, next(_id_counter))
+
+
+def status(status, desc, **extra):
     assert status in ('OK', 'ERROR')
-    return dict(status=status, desc=desc)
+    return dict(extra, status=status, desc=desc)
 
 
-def cached_property(ttl):
-    """A memoize decorator for class properties."""
-    def wrap(fun):
-        @functools.wraps(fun)
-        def get(self):
-            now = time.time()
-            try:
-                ret, last_update = self._cache[fun]
-                if (now - last_update) < ttl:
-                    return ret
-            except AttributeError:
-                self._cache = {}
-            except KeyError:
-                pass
-            ret = fun(self)
-            self._cache[fun] = ret, now
-            return ret
-        return property(get)
-    return wrap
+class StaleWhileRevalidate(object):
+    """Thread-safe cache of the value returned by `fun`.
+
+    `get` never waits for `fun`: once the value is older than `ttl` secs
+    the stale value is returned while a refresh runs on a thread of its
+    own. `default` is returned until the first refresh completes.
+    """
+
+    def __init__(self, fun, ttl, default=None, name=None):
+        self.fun = fun
+        self.ttl = ttl
+        self.name = name or getattr(fun, '__name__', 'swr')
+        self.lock = Lock()
+        self.value = default
+        self.last_update = None
+        self._refreshing = False
+
+    def get(self):
+        with self.lock:
+            if not self._refreshing and self._is_stale():
+                self._refreshing = True
+                thread = Thread(name='refresh %s' % self.name,
+                                target=self._refresh)
+                thread.daemon = True
+                thread.start()
+            return self.value
+
+    def invalidate(self, value=None):
+        """Force a refresh at next `get`, serving `value` meanwhile."""
+        with self.lock:
+            self.value = value
+            self.last_update = None
+
+    def _is_stale(self):
+        return (self.last_update is None or
+                time.time() - self.last_update >= self.ttl)
+
+    def _refresh(self):
+        try:
+            value = self.fun()
+        except Exception:
+            logger.error('error while refreshing %s', self.name,
+                         exc_info=True)
+            with self.lock:
+                self._refreshing = False
+        else:
+            with self.lock:
+                self.value = value
+                self.last_update = time.time()
+                self._refreshing = False
 
 
 def convert_to_international(number, smsc):
@@ -37,3 +122,60 @@ def convert_to_international(number, smsc):
         if smsc.startswith('+39'): # italy
             return '+39' + number
         raise ValueError('convert_to_int. number=%s smsc=%s' % (number, smsc))
+
+
+class TimerHeap(object):
+    """Run callbacks at a later time from a single thread.
+
+    Pending callbacks only cost a heap entry: no thread is held while
+    waiting.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.thread = None
+        self.active = False
+        self.cond = Condition()
+        self.heap = []
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def start(self):
+        self.active = True
+        self.thread = Thread(name=self.name, target=self._work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.active = False
+            self.cond.notify()
+        self.thread.join()
+
+    def call_later(self, delay, callback, *args):
+        deadline = time.time() + delay
+        with self.cond:
+            heapq.heappush(self.heap, (deadline, next(self._seq),
+                                       callback, args))
+            self.cond.notify()
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while self.active:
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    left = self.heap[0][0] - time.time()
+                    if left <= 0:
+                        break
+                    self.cond.wait(left)
+                if not self.active:
+                    return
+                _, _, callback, args = heapq.heappop(self.heap)
+            try:
+                callback(*args)
+            except Exception:
+                logger.error('error in timer callback', exc_info=True)
@@ -1,19 +1,27 @@
+import heapq
+import os
 import time
-from collections import namedtuple, defaultdict
-from threading import Lock, Thread
-from Queue import Queue, Empty
+from collections import namedtuple
+from threading import Condition, RLock, Thread
 
 from gsmmodem.pdu import Concatenation
 from gsmmodem.modem import (GsmModem, TimeoutException, InvalidStateException,
+                            CommandError, CmeError, CmsError,
                             ReceivedSms, StatusReport, Sms)
 
 from msgbox import logger
-from msgbox.actor import Actor, StopActor, Timeout, ChannelClosed
+from msgbox.actor import (Actor, Message, StopActor, Timeout, ChannelClosed,
+                          RejectedMsgException)
+from msgbox.devices import device_cache, device_key
+from msgbox.encoding import plan_sms
 from msgbox.http import http_client_manager
+from msgbox.journal import Spool
+from msgbox.metrics import registry
 from msgbox.sim import (sim_manager, ImsiRegister, ImsiRegistration,
                         ImsiUnregister, SimConfigChanged, TxSmsReq,
                         ShutdownNotification)
-from msgbox.util import status, cached_property, convert_to_international
+from msgbox.util import (status, convert_to_international, unique_id,
+                         StaleWhileRevalidate)
 
 
 # TODO make me nicer
@@ -29,96 +37,316 @@ def sig_stren_desc(n):
     return '%s %s' % (n, desc)
 
 
+CONCAT_SPOOL_FILE = os.path.expanduser('~/.msgbox/concat.spool')
+HELD_SPOOL_FILE = os.path.expanduser('~/.msgbox/rx_held.spool')
+
+
+MT_SEND_SECONDS = registry.histogram('msgbox_mt_send_seconds',
+                                     'time taken by the modem to send an sms',
+                                     ('imsi',))
+MT_SEND_ERRORS = registry.counter('msgbox_mt_send_errors_total',
+                                  'sms the modem failed to send', ('imsi',))
+
+
+class PartialSms(object):
+    """Segments of a multipart sms received so far.
+
+    Fields shared by all the segments are stored once in `header`.
+    """
+
+    __slots__ = ('deadline', 'header', 'parts', 'texts', 'ids', 'size')
+
+    # rough per-segment memory overhead, in bytes
+    SEGMENT_OVERHEAD = 100
+
+    def __init__(self, deadline, segment):
+        self.deadline = deadline
+        self.header = dict((k, v) for k, v in segment.iteritems()
+                                  if k not in ('text', 'concat', 'arrival'))
+        self.parts = segment['concat'][1]
+        self.texts = {}  # {part number: text}
+        self.ids = []
+        self.size = 0
+
+    def add(self, id, segment):
+        number = int(segment['concat'][2])
+        text = segment['text'] or ''
+        if number not in self.texts:
+            self.size += len(text) * 2 + self.SEGMENT_OVERHEAD
+        self.texts[number] = text
+        self.ids.append(id)
+
+    @property
+    def is_complete(self):
+        return len(self.texts) == self.parts
+
+    @property
+    def sms_dict(self):
+        sms_dict = dict(self.header)
+        sms_dict['text'] = ''.join(self.texts.get(i, '<###missing###>')
+                                   for i in range(1, self.parts + 1))
+        return sms_dict
+
+
 class ConcatPool(object):
+    """Reassembles the multipart sms received by all the modems.
+
+    Segments are kept in a spool on disk until their sms is forwarded,
+    so that a restart does not lose them. Expiry is driven by a heap of
+    deadlines: the thread only wakes up when the oldest entry expires.
+
+    Memory is bounded by MAX_ENTRIES and MAX_BYTES: beyond them the
+    oldest partial sms are evicted, i.e. forwarded with the missing
+    parts marked as such.
+    """
 
     CONCAT_TIMEOUT = 300
+    MAX_ENTRIES = 10000
+    MAX_BYTES = 16 * 1024 * 1024
 
-    def __init__(self, worker):
-        self.worker = worker
+    def __init__(self):
         self.thread = None
-        self.lock = Lock()
-        self._stop_queue = Queue()
-        self.pool = defaultdict(lambda: (list(), time.time()))
+        self.active = False
+        self.cond = Condition()
+        self.store = Spool(CONCAT_SPOOL_FILE)
+        self.pool = {}       # {(sender, recipient, ref): PartialSms()}
+        self.deadlines = []  # heap of (deadline, key)
+        self.size = 0
+        self.n_completed = 0
+        self.n_timeouts = 0
+        self.n_evictions = 0
+
+    @property
+    def stats(self):
+        with self.cond:
+            return dict(entries=len(self.pool),
+                        bytes=self.size,
+                        completed=self.n_completed,
+                        timeouts=self.n_timeouts,
+                        evictions=self.n_evictions)
+
+    def metrics(self):
+        stats = self.stats
+        return [
+            ('msgbox_concat_entries', 'gauge',
+             'multipart sms waiting for missing parts',
+             [({}, stats['entries'])]),
+            ('msgbox_concat_bytes', 'gauge',
+             'rough memory taken by the waiting parts',
+             [({}, stats['bytes'])]),
+            ('msgbox_concat_completed_total', 'counter',
+             'multipart sms reassembled', [({}, stats['completed'])]),
+            ('msgbox_concat_timeouts_total', 'counter',
+             'multipart sms forwarded incomplete after timeout',
+             [({}, stats['timeouts'])]),
+            ('msgbox_concat_evictions_total', 'counter',
+             'multipart sms forwarded incomplete to free memory',
+             [({}, stats['evictions'])]),
+        ]
 
     def start(self):
-        self.thread = Thread(name='ConcatPool %s' % self.worker.dev,
-                             target=self._work)
+        self.store.open()
+        for id, segment in self.store.scan():
+            self._add(id, segment)
+        self.active = True
+        self.thread = Thread(name='ConcatPool', target=self._work)
         self.thread.start()
 
     def stop(self):
-        self._stop_queue.put(None)
+        with self.cond:
+            self.active = False
+            self.cond.notify()
         self.thread.join()
+        self.store.close()
 
     def _work(self):
         while True:
-            try:
-                self._stop_queue.get(timeout=10)
-                break
-            except Empty:
-                pass
-            now = time.time()
-            with self.lock:
-                for k, v in self.pool.items():
-                    sms_dicts, tstamp = v
-                    if now - tstamp > self.CONCAT_TIMEOUT:
-                        del self.pool[k]
-                        sms_dict = self._process_concat_msg(sms_dicts)
-                        logger.warn('concat sms timeout - '
-                                    'sender=%s recipient=%s',
-                                     sms_dict['sender'], sms_dict['recipient'])
-                        http_client_manager.enqueue(sms_dict)
+            with self.cond:
+                while self.active:
+                    if not self.deadlines:
+                        self.cond.wait()
+                        continue
+                    left = self.deadlines[0][0] - time.time()
+                    if left <= 0:
+                        break
+                    self.cond.wait(left)
+                if not self.active:
+                    return
+                expired = []
+                now = time.time()
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    partial_sms = self._pop_oldest()
+                    if partial_sms is not None:
+                        self.n_timeouts += 1
+                        expired.append(partial_sms)
+            for partial_sms in expired:
+                sms_dict = partial_sms.sms_dict
+                logger.warn('concat sms timeout - '
+                            'sender=%s recipient=%s',
+                             sms_dict['sender'], sms_dict['recipient'])
+                self._forward(sms_dict, partial_sms)
+
+    def _pop_oldest(self):
+        deadline, key = heapq.heappop(self.deadlines)
+        partial_sms = self.pool.get(key)
+        # entries completed in the meantime leave a stale deadline
+        if partial_sms is None or partial_sms.deadline != deadline:
+            return None
+        del self.pool[key]
+        self.size -= partial_sms.size
+        return partial_sms
 
     def merge(self, sms_dict):
-        with self.lock:
-            concat = sms_dict['concat']
-            key = (sms_dict['sender'],
-                   sms_dict['recipient'],
-                   concat.reference)
-            sms_dicts, tstamp = self.pool[key]
-            sms_dicts.append(sms_dict)
-            if len(sms_dicts) == concat.parts:
+        """Add a segment: the sms is forwarded once all parts are in."""
+        concat = sms_dict['concat']
+        segment = dict(sms_dict,
+                       concat=(concat.reference, concat.parts, concat.number),
+                       arrival=time.time())
+        if segment['tstamp'] is not None:
+            segment['tstamp'] = str(segment['tstamp'])
+        id = unique_id()
+        self.store.add(id, segment)
+        self._add(id, segment)
+
+    def _add(self, id, segment):
+        reference, parts, _ = segment['concat']
+        key = (segment['sender'], segment['recipient'], reference)
+        evicted = []
+        with self.cond:
+            partial_sms = self.pool.get(key)
+            if partial_sms is None:
+                deadline = segment['arrival'] + self.CONCAT_TIMEOUT
+                partial_sms = self.pool[key] = PartialSms(deadline, segment)
+                heapq.heappush(self.deadlines, (deadline, key))
+                self.cond.notify()
+            self.size -= partial_sms.size
+            partial_sms.add(id, segment)
+            self.size += partial_sms.size
+            if partial_sms.is_complete:
                 del self.pool[key]
-                return self._process_concat_msg(sms_dicts)
+                self.size -= partial_sms.size
+                self.n_completed += 1
             else:
-                return None
+                partial_sms = None
+            while self.deadlines and (len(self.pool) > self.MAX_ENTRIES or
+                                      self.size > self.MAX_BYTES):
+                oldest = self._pop_oldest()
+                if oldest is not None:
+                    self.n_evictions += 1
+                    evicted.append(oldest)
+        for oldest in evicted:
+            sms_dict = oldest.sms_dict
+            logger.warn('concat sms evicted - sender=%s recipient=%s',
+                        sms_dict['sender'], sms_dict['recipient'])
+            self._forward(sms_dict, oldest)
+        if partial_sms is not None:
+            self._forward(partial_sms.sms_dict, partial_sms)
+
+    def _forward(self, sms_dict, partial_sms):
+        try:
+            http_client_manager.enqueue(sms_dict)
+        except Exception:
+            # segments are still in the store: retried at next start
+            logger.error('error while forwarding concat sms', exc_info=True)
+            return
+        for id in partial_sms.ids:
+            self.store.ack(id)
 
-    def _process_concat_msg(self, sms_dicts):
-        by_id = {}
-        for sd in sms_dicts:
-            id = int(sd['concat'].number)
-            by_id[id] = sd
-
-        sms_dict = dict(sms_dicts[0])
-        sms_dict['text'] = ''
-        for i in range(1, sms_dict['concat'].parts + 1):
-            sd = by_id.get(i)
-            if sd is None:
-                sms_dict['text'] += '<###missing###>'
-            else:
-                sms_dict['text'] += sd['text']
-        del sms_dict['concat']
-        return sms_dict
+
+concat_pool = ConcatPool()
+
+# received sms notified while their sim was not working yet: forwarded
+# by the sweep of the work state (see ModemWorker._sms_received)
+held_sms = Spool(HELD_SPOOL_FILE)
 
 
 ModemInfo = namedtuple('ModemInfo',
             ['imei', 'manufacturer', 'model', 'network', 'revision', 'signal'])
 
+NetworkStatus = namedtuple('NetworkStatus', ['available', 'signal'])
+
+# assumed until the first network check completes
+UNKNOWN_NETWORK_STATUS = NetworkStatus(available=True, signal=None)
+
+
+class StopWorker(StopActor):
+    """Stop a worker. With `exiting` the whole process is going down:
+    the queued sms tx requests are left in the spool for the restart."""
+
+    def __init__(self, exiting=False):
+        self.exiting = exiting
+
+
+class ModemIdentityChecked(Message):
+    """Outcome of the background check of a cached modem identity."""
+
+    def __init__(self, imsi, modem_info, error=None):
+        self.imsi = imsi
+        self.modem_info = modem_info
+        self.error = error
+
 
 class ModemWorker(Actor):
 
-    def __init__(self, dev, serial_info, serial_manager):
+    # values of `state`, a metric label too: error details are logged
+    STATES = ('initialized', 'connecting', 'no modem detected', 'error',
+              'waiting for config', 'stopped', 'deactivated', 'working',
+              'shutting down')
+    # max sms tx requests waiting to be sent
+    MAILBOX_SIZE = 1000
+    # max queued sms tx requests sent over a single held radio link
+    MAX_BURST = 20
+    # new sms are notified by the modem: storage is swept only as a
+    # safety net for missed notifications
+    SWEEP_INTERVAL = 300
+    # initial guess of the time taken by modem.sendSms
+    SEND_LATENCY = 3.0
+    SEND_LATENCY_ALPHA = 0.2
+    # connection retry delay doubles at every failure, up to the max
+    CONNECT_RETRY_BASE = 5
+    CONNECT_RETRY_MAX = 300
+    # unanswered probes before an unknown port is taken for a non-modem
+    NON_MODEM_PROBES = 3
+    # tried fastest first: autobauding modems lock onto the first rate
+    # they see, the others only answer at their own
+    BAUD_RATES = (115200, 57600, 38400, 19200)
+
+    def __init__(self, dev, serial_info, serial_manager,
+                 modem_factory=GsmModem):
         self.serial_manager = serial_manager
+        self.modem_factory = modem_factory
         self.dev = dev
         self.imsi = None
         self.serial_info = serial_info
+        self.device_key = device_key(serial_info)
         self.modem_info = None
         self.sim_config = None
 
         self.modem = None
-        self.concat_pool = ConcatPool(self)
-        self.concat_pool.start()
+        self.baudrate = None
+        # serializes AT commands issued by the worker and by the network
+        # status refresh thread
+        self.modem_lock = RLock()
+        self.network_status = StaleWhileRevalidate(
+                    self._check_network, ttl=30,
+                    default=UNKNOWN_NETWORK_STATUS,
+                    name='network %s' % dev)
+        self.send_latency = self.SEND_LATENCY
+        # sms of the burst being sent, out of the mailbox already
+        self._in_flight = 0
+        # sms of a burst cut short by a stop request, for shutdown
+        self._unsent = []
+        self._next_sweep = 0
+        self._notifying = None
+        self._cmms_supported = True
+        self._connect_failures = 0
+        self._unanswered_probes = 0
+        self._verifying = False
+        self._exiting = False
         self.state = 'initialized'
-        super(ModemWorker, self).__init__('Modem %s' % dev)
+        super(ModemWorker, self).__init__('Modem %s' % dev,
+                                          maxsize=self.MAILBOX_SIZE,
+                                          bounded_msgs=TxSmsReq)
 
     @property
     def state(self):
@@ -126,10 +354,17 @@ class ModemWorker(Actor):
 
     @state.setter
     def state(self, new_state):
+        assert new_state in self.STATES, new_state
         if hasattr(self, '_state') and new_state != self._state:
             logger.info('STATE %s -> %s', self._state, new_state)
         self._state = new_state
 
+    @property
+    def expected_wait(self):
+        """Estimated secs before a new sms tx request would be sent."""
+        queued = self.mailbox.qsize() + self._in_flight
+        return (queued + 1) * self.send_latency
+
     def run(self):
         step = self.connect
         try:
@@ -145,41 +380,108 @@ class ModemWorker(Actor):
     def connect(self):
         self.state = 'connecting'
         try:
-            self.modem = GsmModem(self.dev, 19200)
-            self.modem.connect()
+            self.modem = self._open_modem()
         except TimeoutException:
             self.state = 'no modem detected'
+            self._unanswered_probes += 1
         except Exception, e:
-            self.state = 'error %s' % e
+            logger.error('error while connecting to %s: %r', self.dev, e)
+            self.state = 'error'
         else:
             logger.debug('found modem on %r', self.dev)
+            # python-gsmmodem turns sms notifications on at connect
+            self._notifying = True
+            self._update_sms_notifications()
+            device_cache.probed(self.device_key, modem=True)
+            cached = device_cache.get(self.device_key)
+            if cached.get('imsi') and cached.get('modem_info'):
+                # warm start: registered right away, checked meanwhile
+                try:
+                    self.imsi = cached['imsi']
+                    self.modem_info = ModemInfo(**cached['modem_info'])
+                except Exception, e:
+                    # written by another version of msgbox: cold start
+                    logger.warn('cached identity of %s ignored: %r',
+                                self.dev, e)
+                    self.imsi = self.modem_info = None
+                else:
+                    self._start_identity_check()
+                    self._connect_failures = 0
+                    return self.register
             try:
                 self.imsi, self.modem_info = self._get_modem_info()
             except Exception, e:
-                self.state = 'error %s' % e
+                logger.error('error while reading the identity of %s: %r',
+                             self.dev, e)
+                self.state = 'error'
             else:
+                self._save_identity()
+                self._connect_failures = 0
                 return self.register
 
         self._try_modem_close()
-        msg = self.receive(typ=StopActor, timeout=50)
-        if isinstance(msg, StopActor):
+        # a port that once had a modem is retried forever
+        if (self._unanswered_probes >= self.NON_MODEM_PROBES and
+            not device_cache.is_modem(self.device_key)):
+            logger.info('no modem on %s (%s): port ignored for %ds',
+                        self.dev, self.device_key,
+                        device_cache.NON_MODEM_TTL)
+            device_cache.probed(self.device_key, modem=False)
             return self.shutdown
+        delay = min(self.CONNECT_RETRY_BASE * 2 ** self._connect_failures,
+                    self.CONNECT_RETRY_MAX)
+        self._connect_failures += 1
+        msg = self.receive(typ=StopActor, timeout=delay)
+        if isinstance(msg, StopActor):
+            return self._stop_requested(msg)
         if isinstance(msg, Timeout):
             return self.connect
 
     def shutdown(self):
         self.state = 'shutting down'
         self._try_modem_close()
-        self.concat_pool.stop()
         self.close_channel()
-        msg = self.receive()
-        if isinstance(msg, ChannelClosed):
-            self._unregister()
-            return None
+        rerouted = []
+        unsent, self._unsent = self._unsent, []
+        for tx_sms in unsent:
+            self._abandon(tx_sms, rerouted)
+        while True:
+            msg = self.receive()
+            if isinstance(msg, ChannelClosed):
+                self._unregister()
+                # after the unregistration: routed to the other sims
+                for tx_sms in rerouted:
+                    self._reroute(tx_sms)
+                self._notify_shutdown()
+                return None
+            elif isinstance(msg, TxSmsReq):
+                self._abandon(msg, rerouted)
+            elif isinstance(msg, (SimConfigChanged, ModemIdentityChecked)):
+                pass
+            else:
+                logger.error('unexpected msg type %s', msg)
+
+    def _abandon(self, tx_sms, rerouted):
+        if self._exiting:
+            # still spooled: it will be replayed at next startup
+            logger.warn('%s: left in spool', tx_sms)
+        elif tx_sms.pool:
+            rerouted.append(tx_sms)
         else:
-            # FIXME there may be a queue of SMS txt requests
-            logger.error('unexpected msg type %s', msg)
-            return self.shutdown
+            err_msg = '%s: modem shut down' % tx_sms
+            tx_sms.callback(status('ERROR', err_msg))
+
+    def _stop_requested(self, msg):
+        self._exiting = isinstance(msg, StopWorker) and msg.exiting
+        return self.shutdown
+
+    def _reroute(self, tx_sms):
+        logger.info('%s: handed back for rerouting', tx_sms)
+        try:
+            sim_manager.send(tx_sms)
+        except RejectedMsgException, e:
+            tx_sms.callback(status('ERROR', '%s: overloaded' % tx_sms,
+                                   retry_after=e.retry_after, code=503))
 
     def register(self):
         assert self.sim_config is None
@@ -187,6 +489,7 @@ class ModemWorker(Actor):
         registration = self.receive(typ=ImsiRegistration)
         if registration.success:
             self.sim_config = registration.config
+            self._update_sms_notifications()
             if self.sim_config.is_startable:
                 return self.work
             else:
@@ -199,15 +502,18 @@ class ModemWorker(Actor):
             self.state = 'waiting for config'
         else:
             self.state = 'stopped'
-        msg = self.receive()
+        msg = self.receive(typ=(StopActor, SimConfigChanged, TxSmsReq,
+                                ModemIdentityChecked))
         if isinstance(msg, StopActor):
-            return self.shutdown
+            return self._stop_requested(msg)
         elif isinstance(msg, SimConfigChanged):
-            # FIXME
-            return self.work
+            return self._apply_config(msg.config)
+        elif isinstance(msg, ModemIdentityChecked):
+            return self._identity_checked(msg, self.stop)
         elif isinstance(msg, Timeout):
             return self.register
         elif isinstance(msg, TxSmsReq):
+            msg.mark('dequeue')
             self._send_sms_when_stopped(msg)
             return self.stop
         else:
@@ -215,34 +521,49 @@ class ModemWorker(Actor):
             return self.stop
 
     def deactivate(self):
-        # FIXME sim hot swap not supported here
+        if self._verifying:
+            # the cached imsi may be the reason registration failed
+            msg = self.receive(typ=(StopActor, ModemIdentityChecked))
+            if isinstance(msg, StopActor):
+                return self._stop_requested(msg)
+            next_step = self._identity_checked(msg, self.deactivate)
+            if next_step != self.deactivate:
+                return next_step
         self._try_modem_close()
         self.state = 'deactivated'
-        self.receive(typ=StopActor)
-        return self.shutdown
+        msg = self.receive(typ=StopActor)
+        return self._stop_requested(msg)
 
     def work(self):
         self.state = 'working'
-        try:
-            self._process_stored_sms()
-        except Exception:
-            logger.error('error while processing stored sms', exc_info=True)
-            self.serial_manager.send(ShutdownNotification(self))
-            return self.shutdown
+        if time.time() >= self._next_sweep:
+            try:
+                self._process_stored_sms()
+            except Exception, e:
+                self._forget_baudrate(e)
+                logger.error('error while processing stored sms',
+                             exc_info=True)
+                return self.shutdown
+            self._next_sweep = time.time() + self.SWEEP_INTERVAL
 
         # TODO check imsi (sim hot swap)
             
         msg = self.receive(timeout=5)
         if isinstance(msg, StopActor):
-            return self.shutdown
+            return self._stop_requested(msg)
         elif isinstance(msg, SimConfigChanged):
-            # FIXME
-            return self.work
+            return self._apply_config(msg.config)
+        elif isinstance(msg, ModemIdentityChecked):
+            return self._identity_checked(msg, self.work)
         elif isinstance(msg, Timeout):
-            self._is_network_available
+            self.network_status.get()
             return self.work
         elif isinstance(msg, TxSmsReq):
-            self._send_sms(msg)
+            msg.mark('dequeue')
+            self._send_burst(msg)
+            if self.mailbox.has(StopActor):
+                # ahead of the sms tx requests still queued
+                return self._stop_requested(self.receive(typ=StopActor))
             return self.work
         else:
             logger.error('unexpected msg type %s', msg)
@@ -250,49 +571,315 @@ class ModemWorker(Actor):
 
     # ~~~~~ utils ~~~~~
 
+    def _open_modem(self):
+        """Return the modem connected at the first baud rate that works:
+        the one cached for the device, then BAUD_RATES in order.
+
+        Only timeouts and garbled replies (errors without a CME/CMS code)
+        mean a wrong rate: other errors (sim pin, permissions, ...) are
+        raised right away, as is the error of the last rate tried if none
+        works.
+        """
+        cached = device_cache.get(self.device_key).get('baudrate')
+        rates = [r for r in self.BAUD_RATES if r != cached]
+        if cached:
+            rates.insert(0, cached)
+        for rate in rates:
+            modem = self.modem_factory(self.dev, rate,
+                                smsReceivedCallbackFunc=self._sms_received)
+            try:
+                modem.connect()
+            except (TimeoutException, CommandError), e:
+                self._try_close(modem)
+                if isinstance(e, (CmeError, CmsError)):
+                    # understood by the modem: the rate is right
+                    raise
+                # no answer or garbled answers: wrong rate
+                logger.debug('no modem on %s at %d baud: %r', self.dev,
+                             rate, e)
+                error = e
+                continue
+            except Exception:
+                self._try_close(modem)
+                raise
+            if rate != cached:
+                logger.info('modem on %s answers at %d baud', self.dev, rate)
+                device_cache.update(self.device_key, baudrate=rate)
+            self.baudrate = rate
+            return modem
+        raise error
+
+    @staticmethod
+    def _try_close(modem):
+        try:
+            modem.close()
+        except Exception:
+            pass
+
+    def _forget_baudrate(self, error):
+        # a reset or swapped modem may answer at another rate: the next
+        # connect probes them all
+        if isinstance(error, EnvironmentError) and self.baudrate is not None:
+            logger.info('%s: i/o error, cached baud rate dropped', self.dev)
+            device_cache.update(self.device_key, baudrate=None)
+            self.baudrate = None
+
+    def _start_identity_check(self):
+        self._verifying = True
+        thread = Thread(name='identity %s' % self.dev,
+                        target=self._check_identity)
+        thread.daemon = True
+        thread.start()
+
+    def _check_identity(self):
+        # runs on a thread of its own
+        try:
+            with self.modem_lock:
+                imsi, modem_info = self._get_modem_info()
+        except Exception, e:
+            msg = ModemIdentityChecked(None, None, error=e)
+        else:
+            msg = ModemIdentityChecked(imsi, modem_info)
+        try:
+            self.send(msg)
+        except RejectedMsgException:
+            # shutting down
+            pass
+
+    def _identity_checked(self, msg, next_step):
+        """Return the next state once the modem identity is checked:
+        `next_step` unless the sim has been swapped."""
+        self._verifying = False
+        if msg.error is not None:
+            logger.warn('could not check the identity of modem on %s: %s',
+                        self.dev, msg.error)
+            return next_step
+        self.modem_info = msg.modem_info
+        if msg.imsi == self.imsi:
+            self._save_identity()
+            return next_step
+        logger.warn('sim swap on %s: imsi %s -> %s', self.dev, self.imsi,
+                    msg.imsi)
+        while True:
+            tx_sms = self.receive(typ=TxSmsReq, block=False)
+            if isinstance(tx_sms, Timeout):
+                break
+            tx_sms.callback(status('ERROR', '%s: sim swapped' % tx_sms))
+        self._unregister()
+        self.imsi = msg.imsi
+        self._save_identity()
+        return self.register
+
+    def _save_identity(self):
+        device_cache.update(self.device_key, imsi=self.imsi,
+                            modem_info=dict(self.modem_info._asdict()))
+
+    def _apply_config(self, sim_config):
+        """Switch to `sim_config` in place: the modem stays connected."""
+        logger.info('new config for imsi %s: phone_number=%s url=%s '
+                    'active=%s', self.imsi, sim_config.phone_number,
+                    sim_config.url, sim_config.active)
+        self.sim_config = sim_config
+        self._update_sms_notifications()
+        if sim_config.is_startable:
+            return self.work
+        else:
+            return self.stop
+
     def _send_sms_when_stopped(self, tx_sms):
-        assert tx_sms.sender is None
+        # deactivated sims keep their phone number: requests routed by
+        # sender may show up here too
         if not self.sim_config.active:
             err_msg = '%s: modem is not active' % tx_sms
             tx_sms.callback(status('ERROR', err_msg))
         else:
             self._send_sms(tx_sms)
 
+    def _send_burst(self, tx_sms):
+        """Send `tx_sms` along with the next queued sms tx requests,
+        keeping the link to the SMSC open between them (AT+CMMS).
+
+        The burst ends at the first msg of another type, and is cut short
+        by a stop request: the sms not sent yet are left to shutdown.
+        """
+        burst = [tx_sms]
+        while len(burst) < self.MAX_BURST:
+            msg = self.receive_next(TxSmsReq)
+            if isinstance(msg, Timeout):
+                break
+            msg.mark('dequeue')
+            burst.append(msg)
+
+        self._in_flight = len(burst)
+        with self.modem_lock:
+            hold_link = len(burst) > 1 and self._set_cmms(1)
+            if hold_link:
+                logger.info('sending %d sms with link held', len(burst))
+            try:
+                for i, tx_sms in enumerate(burst):
+                    if self.mailbox.has(StopActor):
+                        logger.info('stop requested: %d sms of the burst '
+                                    'not sent', len(burst) - i)
+                        self._unsent = burst[i:]
+                        break
+                    self._send_sms(tx_sms)
+                    self._in_flight -= 1
+            finally:
+                self._in_flight = 0
+                if hold_link:
+                    self._set_cmms(0)
+
+    def _set_cmms(self, mode):
+        if not self._cmms_supported:
+            return False
+        try:
+            self.modem.write('AT+CMMS=%d' % mode)
+        except Exception, e:
+            logger.info('AT+CMMS not supported: %s', e)
+            self._cmms_supported = False
+            return False
+        return True
+
     def _send_sms(self, tx_sms):
         # TODO handle delivery report
-        if not self._is_network_available:
+        if not self.network_status.get().available:
             err_msg = '%s: network unavailable' % tx_sms
             tx_sms.callback(status('ERROR', err_msg))
             return
         try:
-            self.modem.sendSms(tx_sms.recipient, tx_sms.text)
+            plan = plan_sms(tx_sms.text, self.sim_config.encoding_policy)
+        except (TypeError, ValueError), e:
+            tx_sms.callback(status('ERROR', '%s: %s' % (tx_sms, e)))
+            return
+        if plan.text != tx_sms.text:
+            logger.info('%s: transliterated to %s (%d part(s))', tx_sms,
+                        plan.encoding, plan.parts)
+        start = time.time()
+        try:
+            with self.modem_lock:
+                tx_sms.mark('send_start')
+                self.modem.sendSms(tx_sms.recipient, plan.text)
+                tx_sms.mark('send_end')
+            elapsed = time.time() - start
+            MT_SEND_SECONDS.labels(self.imsi).observe(elapsed)
+            alpha = self.SEND_LATENCY_ALPHA
+            self.send_latency += alpha * (elapsed - self.send_latency)
         except Exception, e:
+            self._forget_baudrate(e)
+            MT_SEND_ERRORS.labels(self.imsi).inc()
             logger.error('error:', exc_info=True)
             tx_sms.callback(status('ERROR', '%s: %r' % (tx_sms, e)))
         else:
-            tx_sms.callback(status('OK', '%s: sms sent' % tx_sms))
-
-    @cached_property(ttl=30)
-    def _is_network_available(self):
+            tx_sms.callback(status('OK', '%s: sms sent' % tx_sms,
+                                   parts=plan.parts, encoding=plan.encoding))
+
+    def _check_network(self):
+        # runs on the refresh thread: a busy modem is sending, so the
+        # last known status is kept rather than waiting for it
+        if not self.modem_lock.acquire(False):
+            return self.network_status.value
         try:
-            sig_strength = self.modem.waitForNetworkCoverage(timeout=3)
-            ret = sig_strength > 0
+            modem = self.modem
+            if modem is None:
+                return UNKNOWN_NETWORK_STATUS
+            sig_strength = modem.waitForNetworkCoverage(timeout=3)
+            ret = NetworkStatus(available=sig_strength > 0,
+                                signal=sig_strength)
         except (TimeoutException, InvalidStateException):
-            ret = False
-        except Exception:
-            ret = False
-        _log = logger.info if ret else logger.error
-        _log('network check: available=%s', ret)
+            ret = NetworkStatus(available=False, signal=None)
+        except Exception, e:
+            self._forget_baudrate(e)
+            ret = NetworkStatus(available=False, signal=None)
+        finally:
+            self.modem_lock.release()
+        _log = logger.info if ret.available else logger.error
+        _log('network check: available=%s', ret.available)
         return ret
 
+    def _update_sms_notifications(self):
+        """Have new sms notified (+CMTI) only while the sim is startable.
+
+        python-gsmmodem deletes a notified sms from the sim before its
+        callback runs: while the sim can't forward it, the sms is left on
+        the sim instead, for the sweep of the work state.
+        """
+        sim_config = self.sim_config
+        notify = sim_config is not None and sim_config.is_startable
+        if self.modem is None or notify == self._notifying:
+            return
+        try:
+            with self.modem_lock:
+                self.modem.write('AT+CNMI=2,%d,0,2' % notify)
+        except Exception, e:
+            logger.error('error while setting sms notifications: %s', e)
+            return
+        self._notifying = notify
+        if notify:
+            # pick up what was left on the sim in the meantime
+            self._next_sweep = 0
+
+    def _sms_received(self, sms):
+        # called by python-gsmmodem on a thread of its own, the sms is
+        # already deleted from the sim: spool it right away. connect()
+        # turns notifications on before the sim config is known, sms
+        # the sim can't forward yet are held for the work state.
+        logger.debug('sms notification on %s', self.dev)
+        sim_config = self.sim_config
+        try:
+            if sim_config is not None and sim_config.is_startable:
+                self._rx_sms(sms, sim_config)
+            else:
+                self._hold_sms(sms)
+        except Exception:
+            logger.error('sms lost - sender=%s text=%r', sms.number,
+                         sms.text, exc_info=True)
+
+    def _hold_sms(self, sms):
+        if not isinstance(sms, ReceivedSms):
+            return
+        concats = [i for i in sms.udh or () if isinstance(i, Concatenation)]
+        concat = concats[0] if concats else None
+        held_sms.add(unique_id(), dict(
+            device_key=self.device_key,
+            number=sms.number,
+            smsc=sms.smsc,
+            text=sms.text,
+            tstamp=str(sms.time) if sms.time is not None else None,
+            concat=(concat.reference, concat.parts, concat.number)
+                   if concat else None))
+        logger.warn('sms held until %s works - sender=%s', self.dev,
+                    sms.number)
+        # picked up by the next sweep if the work state is running
+        self._next_sweep = 0
+
     def _process_stored_sms(self):
         states = [Sms.STATUS_RECEIVED_READ, Sms.STATUS_RECEIVED_UNREAD]
         for status in states:
-            messages = self.modem.listStoredSms(status=status, delete=True)
+            with self.modem_lock:
+                messages = self.modem.listStoredSms(status=status,
+                                                    delete=True)
             for sms in messages:
-                self._rx_sms(sms)
-
-    def _rx_sms(self, sms):
+                self._rx_sms(sms, self.sim_config)
+        if len(held_sms):
+            self._process_held_sms()
+
+    def _process_held_sms(self):
+        for id, held in list(held_sms.scan()):
+            if held['device_key'] != self.device_key:
+                continue
+            sms = ReceivedSms(self.modem, Sms.STATUS_RECEIVED_READ,
+                              held['number'], held['tstamp'], held['text'],
+                              held['smsc'])
+            sms.udh = None
+            if held['concat'] is not None:
+                concat = Concatenation()
+                concat.reference, concat.parts, concat.number = \
+                    held['concat']
+                sms.udh = [concat]
+            self._rx_sms(sms, self.sim_config)
+            held_sms.ack(id)
+
+    def _rx_sms(self, sms, sim_config):
         if isinstance(sms, ReceivedSms):
             try:
                 number = convert_to_international(sms.number, sms.smsc)
@@ -300,10 +887,13 @@ class ModemWorker(Actor):
                 logger.error('error while converting to int: %s', e)
                 number = sms.number
             sms_dict = dict(sender=number,
-                            recipient=self.sim_config.phone_number,
+                            recipient=sim_config.phone_number,
                             text=sms.text,
                             tstamp=sms.time,
-                            url=self.sim_config.url)
+                            url=sim_config.url)
+            if sim_config.batch_size:
+                sms_dict['batch'] = (sim_config.batch_size,
+                                     sim_config.batch_linger)
 
             if sms.udh is not None:
                 concats = [i for i in sms.udh if isinstance(i, Concatenation)]
@@ -316,9 +906,7 @@ class ModemWorker(Actor):
                                  sms_dict['recipient'],
                                  sms_dict['concat'].number,
                                  sms_dict['concat'].parts)
-                    concat_sms_dict = self.concat_pool.merge(sms_dict)
-                    if concat_sms_dict:
-                        http_client_manager.enqueue(concat_sms_dict)
+                    concat_pool.merge(sms_dict)
                     return
 
             http_client_manager.enqueue(sms_dict)
@@ -338,12 +926,22 @@ class ModemWorker(Actor):
         if self.sim_config is not None:
             sim_manager.send(ImsiUnregister(self))
             self.sim_config = None
+            self._update_sms_notifications()
+
+    def _notify_shutdown(self):
+        try:
+            self.serial_manager.send(ShutdownNotification(self))
+        except RejectedMsgException:
+            # the serial manager has quit already
+            pass
 
     def _try_modem_close(self):
         if self.modem is not None:
             try:
-                self.modem.close()
+                with self.modem_lock:
+                    self.modem.close()
             except Exception, e:
                 logger.info('error while closing modem: %s', e)
             finally:
                 self.modem = None
+                self.network_status.invalidate(UNKNOWN_NETWORK_STATUS)